@@ -0,0 +1,50 @@
+import argparse
+import os
+import seispy
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ttdir", type=str, help="output directory")
+    parser.add_argument("vmodel", type=str, help="velocity model")
+    parser.add_argument("db", type=str,
+                        help="css3.0 database with a site table")
+    parser.add_argument("--format", type=str, default="fang",
+                        help="velocity model format")
+    parser.add_argument("--grid", type=float, nargs=9, required=True,
+                        metavar=("LAT0", "LON0", "DEPTH0",
+                                 "NLAT", "NLON", "NDEPTH",
+                                 "DLAT", "DLON", "DDEPTH"),
+                        help="grid specification")
+    parser.add_argument("--phases", type=str, nargs="+", default=["P", "S"],
+                        help="phases")
+    parser.add_argument("--ext", type=str, default="",
+                        help="file name extension")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("--restart", action="store_true",
+                        help="discard any checkpoint and rebuild every "
+                             "table")
+    return(parser.parse_args())
+
+def main():
+    args = parse_args()
+    lat0, lon0, depth0, nlat, nlon, ndepth, dlat, dlon, ddepth = args.grid
+    grid = seispy.geogrid.GeoGrid3D(lat0, lon0, depth0,
+                                    int(nlat), int(nlon), int(ndepth),
+                                    dlat, dlon, ddepth)
+    vmodel = seispy.velocity.VelocityModel(os.path.abspath(args.vmodel),
+                                           args.format)
+    site = seispy.pandas.io.fixed_width.read_fwf(os.path.abspath(args.db),
+                                                 tables=["site"])["site"]
+    paths = seispy.ttbuild.build_tables(os.path.abspath(args.ttdir),
+                                        vmodel,
+                                        site,
+                                        grid,
+                                        phases=args.phases,
+                                        ext=args.ext,
+                                        max_workers=args.workers,
+                                        resume=not args.restart)
+    print("{:d} tables in {}".format(len(paths), os.path.abspath(args.ttdir)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import argparse
+import os
+import seispy
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ttdir", type=str, help="travel-time directory")
+    parser.add_argument("--no-checksum", action="store_true",
+                        help="do not compute file checksums")
+    parser.add_argument("--verify", action="store_true",
+                        help="verify files against an existing manifest "
+                             "instead of writing one")
+    return(parser.parse_args())
+
+def main():
+    args = parse_args()
+    ttdir = os.path.abspath(args.ttdir)
+    if args.verify:
+        seispy.ttgrid.TTGrid(ttdir).verify(checksum=not args.no_checksum)
+        print("OK")
+    else:
+        print(seispy.ttgrid.write_manifest(ttdir,
+                                           checksum=not args.no_checksum))
+
+if __name__ == "__main__":
+    main()
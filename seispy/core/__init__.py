@@ -1,18 +1,24 @@
 # coding=utf-8
 
+from . import atomic
 from . import constants
 from . import coords
+from . import eikonal
 from . import faults
 from . import fmm3dio
 from . import geogrid
 from . import geometry
+from . import locate
 try:
     from . import mapping
 except ImportError:
     print("seispy.core.mapping could not be imported, probably due to "
           "missing mpl_toolkits.basemap module.")
+from . import rays
 from . import stats
 from . import surface
 from . import topography
+from . import ttbuild
+from . import ttcompress
 from . import ttgrid
 from . import velocity
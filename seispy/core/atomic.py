@@ -0,0 +1,107 @@
+# coding=utf-8
+"""
+Atomic file writes.
+
+.. autoclass:: AtomicFile
+   :members:
+"""
+import os
+import tempfile
+
+# The process umask, applied to temporary files, which mkstemp creates
+# readable by their owner only. It is read once, at import, because
+# reading it means setting it.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class AtomicFile(object):
+    """
+    A file written under a unique temporary name in the directory of
+    **path** and moved into place only when complete, so that readers
+    never see a partial file and concurrent writers of the same path
+    never share a temporary file; the last one to finish wins.
+
+    Used as a context manager, the open file is returned and the
+    write is committed on success and discarded on error::
+
+        with AtomicFile(path, "w") as outfile:
+            outfile.write(text)
+
+    Otherwise write to :attr:`file` and call :meth:`commit` or
+    :meth:`discard`.
+
+    :param str path: output path
+    :param str mode: file mode, "w" or "wb"
+    """
+    def __init__(self, path, mode="wb"):
+        self.path = os.path.abspath(path)
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                        prefix="." + os.path.basename(self.path)
+                                               + ".",
+                                        suffix=".tmp")
+        try:
+            os.chmod(self.tmp, 0o666 & ~_UMASK)
+            self.file = os.fdopen(fd, mode)
+        except BaseException:
+            os.close(fd)
+            os.remove(self.tmp)
+            raise
+
+    def __enter__(self):
+        return(self.file)
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    @property
+    def closed(self):
+        return(self.file.closed)
+
+    def commit(self):
+        """
+        Flush the file to disk, close it and move it into place. The
+        directory is synced after the rename, so that after a crash
+        the path holds either the old or the complete new file.
+        """
+        if self.file.closed:
+            return
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        except BaseException:
+            self.discard()
+            raise
+        os.replace(self.tmp, self.path)
+        _fsync_directory(os.path.dirname(self.path))
+
+    def discard(self):
+        """
+        Close and remove the temporary file.
+        """
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def _fsync_directory(path):
+    """
+    Flush the entries of directory **path** to disk. Platforms that
+    cannot open directories, such as Windows, are skipped.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Some file systems do not support syncing directories.
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,360 @@
+# coding=utf-8
+"""
+A vectorized fast-marching solver of the eikonal equation on the
+regular spherical grids described by :class:`~seispy.geogrid.GeoGrid3D`.
+
+Travel-time volumes are returned with shape (nr, nlat, nlon), with
+radius, latitude and longitude increasing along the axes, which is the
+layout written by :func:`seispy.ttgrid.write_ttgrid`.
+
+The narrow band is advanced in groups of nodes with NumPy array
+operations rather than one node at a time, at a few hundred thousand
+nodes per second on one core. Memory use is about 45 bytes per node.
+
+.. autofunction:: solve
+.. autofunction:: sample_velocity
+.. autofunction:: write_travel_times
+"""
+import time
+
+import numpy as np
+import scipy.ndimage
+
+from . import constants as _constants
+from . import ttgrid as _ttgrid
+
+FAR, TRIAL, KNOWN = 0, 1, 2
+HALO = 2
+MAXITER = 8
+
+
+def grid_coordinates(grid):
+    """
+    Return the spherical coordinates of every node of **grid**.
+
+    :param GeoGrid3D grid: grid specification
+    :returns: radius, polar and azimuthal coordinates, each with shape
+              (nr, nlat, nlon)
+    :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+    r = grid.rho0 + np.arange(grid.nrho) * grid.drho
+    theta = np.radians(90. - (grid.lat0 + np.arange(grid.nlat) * grid.dlat))
+    phi = np.radians(grid.lon0 + np.arange(grid.nlon) * grid.dlon)
+    return(np.meshgrid(r, theta, phi, indexing="ij"))
+
+
+def sample_velocity(vmodel, phase, grid):
+    """
+    Sample **phase**-velocity of a VelocityModel at every node of
+    **grid**.
+
+    :param VelocityModel vmodel: velocity model
+    :param str phase: phase
+    :param GeoGrid3D grid: grid specification
+    :returns: velocity with shape (nr, nlat, nlon)
+    :rtype: numpy.ndarray
+    """
+    return(vmodel.get_velocity(phase, *grid_coordinates(grid)))
+
+
+def solve(velocity, grid, source, phase="P", init_radius=3.):
+    """
+    Return the travel time from **source** to every node of **grid**.
+
+    Each node is updated with a mixed first/second-order upwind
+    stencil in the local metric (dr, r dtheta, r sin(theta) dphi).
+    Nodes within **init_radius** grid cells of the source are
+    initialized with straight-ray travel times to reduce the error
+    from the point-source singularity. See :func:`_march` for the
+    order in which nodes are accepted.
+
+    :param velocity: velocity model, or velocities sampled at the grid
+                     nodes with shape (nr, nlat, nlon)
+    :type velocity: VelocityModel or numpy.ndarray
+    :param GeoGrid3D grid: grid specification
+    :param array-like source: geographic source coordinates (lat, lon,
+                              depth)
+    :param str phase: phase, used only if **velocity** is a
+                      VelocityModel
+    :param float init_radius: radius of the initialization region in
+                              grid cells
+    :returns: travel times with shape (nr, nlat, nlon)
+    :rtype: numpy.ndarray
+    """
+    shape = (grid.nrho, grid.nlat, grid.nlon)
+    if not isinstance(velocity, np.ndarray):
+        velocity = sample_velocity(velocity, phase, grid)
+    if not velocity.shape == shape:
+        raise(ValueError("velocity does not match grid"))
+    slowness = 1. / np.asarray(velocity, dtype=np.float64)
+
+    # Fractional index coordinates of the source.
+    lat, lon, depth = source
+    xs = np.array([(_constants.EARTH_RADIUS - depth - grid.rho0) / grid.drho,
+                   (lat - grid.lat0) / grid.dlat,
+                   (lon - grid.lon0) / grid.dlon])
+    if np.any(xs < 0) or np.any(xs > np.array(shape) - 1):
+        raise(ValueError("source lies outside grid"))
+    ss = scipy.ndimage.map_coordinates(slowness, xs[:, None], order=1)[0]
+
+    # Straight-ray travel times around the source; coordinates are
+    # only needed inside the initialization box.
+    rs = _constants.EARTH_RADIUS - depth
+    ts, ps = np.radians(90. - lat), np.radians(lon)
+    lo = np.maximum(np.floor(xs - init_radius).astype(int), 0)
+    hi = np.minimum(np.ceil(xs + init_radius).astype(int) + 1, shape)
+    box = tuple(slice(l, h) for l, h in zip(lo, hi))
+    r = grid.rho0 + np.arange(lo[0], hi[0]) * grid.drho
+    theta = np.radians(90. - (grid.lat0 + np.arange(lo[1], hi[1]) * grid.dlat))
+    phi = np.radians(grid.lon0 + np.arange(lo[2], hi[2]) * grid.dlon)
+    dist = _chord(r[:, None, None], theta[None, :, None], phi[None, None, :],
+                  rs, ts, ps)
+
+    return(_march(slowness, grid, box, dist * 0.5 * (slowness[box] + ss)))
+
+
+def _chord(r, theta, phi, r0, theta0, phi0):
+    """
+    Return the straight-line distance between spherical coordinates.
+    """
+    cosd = np.cos(theta) * np.cos(theta0)\
+         + np.sin(theta) * np.sin(theta0) * np.cos(phi - phi0)
+    return(np.sqrt(np.maximum(r**2 + r0**2 - 2 * r * r0 * cosd, 0)))
+
+
+def _march(slowness, grid, box, tbox):
+    """
+    Run fast marching outward from the nodes in **box**, whose travel
+    times **tbox** are KNOWN.
+
+    Rather than accepting one node at a time from a heap, every TRIAL
+    node whose travel time is within *dt* of the smallest one is
+    accepted at once and its neighbours are updated together (the
+    group marching method). *dt* is the smallest possible increase of
+    travel time in one update from a single neighbour, so nodes of a
+    group barely depend on one another; the group is relaxed against
+    itself to account for the dependence that remains. The result
+    closely matches node-by-node fast marching, while the work is done
+    in array operations over the narrow band.
+    """
+    # A halo of two KNOWN nodes with infinite travel times spares the
+    # stencils any bounds checks.
+    shape = tuple(n + 2 * HALO for n in slowness.shape)
+    inner = (slice(HALO, -HALO),) * 3
+    box = tuple(slice(b.start + HALO, b.stop + HALO) for b in box)
+    S = np.full(shape, KNOWN, dtype=np.int8)
+    S[inner] = FAR
+    S[box] = KNOWN
+    S = S.ravel()
+    # Travel times of KNOWN nodes are kept in K and those of TRIAL
+    # nodes in T; both are infinite elsewhere.
+    K = np.full(shape, np.inf)
+    K[box] = tbox
+    K = K.ravel()
+    T = np.full(len(K), np.inf)
+    s2 = np.zeros(shape)
+    s2[inner] = np.square(slowness)
+    s2 = s2.ravel()
+    # Node spacings depend only on radius and polar angle, so they are
+    # kept as 1-D and 2-D tables rather than per-node arrays.
+    r = grid.rho0 + np.arange(slowness.shape[0]) * grid.drho
+    theta = np.radians(90. - (grid.lat0
+                              + np.arange(slowness.shape[1]) * grid.dlat))
+    h = (float(grid.drho),
+         r * np.radians(grid.dlat),
+         np.outer(r, np.abs(np.sin(theta))) * np.radians(grid.dlon))
+    # One update from a single neighbour increases the travel time by
+    # at least s hmin / (1.5 sqrt(3)); 1.5 is the second-order stencil
+    # factor.
+    dt = np.sqrt(np.square(slowness).min())\
+        * min(h[0], h[1].min(), h[2].min()) / (1.5 * np.sqrt(3.))
+    h2inv = (h[0] ** -2.,
+             np.pad(h[1] ** -2., HALO, mode="edge"),
+             np.pad(h[2] ** -2., HALO, mode="edge"))
+
+    def update(n):
+        return(_update(n, K, s2, h2inv, shape))
+
+    trial = _neighbours(np.flatnonzero(np.isfinite(K)), shape)
+    trial = trial[S[trial] == FAR]
+    T[trial] = update(trial)
+    S[trial] = TRIAL
+    ingroup = np.zeros(len(S), dtype=bool)
+    while len(trial):
+        t = T[trial]
+        accept = t <= t.min() + dt
+        group, trial = trial[accept], trial[~accept]
+        S[group] = KNOWN
+        K[group] = T[group]
+        T[group] = np.inf
+        # A multi-term update can still lower a node slightly using
+        # another node of its group, so the group is relaxed against
+        # itself, revisiting only neighbours of nodes that changed.
+        ingroup[group] = True
+        active = group
+        for _ in range(MAXITER):
+            t = update(active)
+            lower = t < K[active]
+            if not np.any(lower):
+                break
+            K[active[lower]] = t[lower]
+            active = _neighbours(active[lower], shape)
+            active = active[ingroup[active]]
+        ingroup[group] = False
+        neighbours = _neighbours(group, shape)
+        neighbours = neighbours[S[neighbours] != KNOWN]
+        T[neighbours] = np.minimum(T[neighbours], update(neighbours))
+        new = neighbours[S[neighbours] == FAR]
+        S[new] = TRIAL
+        trial = np.concatenate([trial, new])
+    return(K.reshape(shape)[inner].copy())
+
+
+def _neighbours(n, shape):
+    """
+    Return the unique flat indices of the neighbours of nodes **n**.
+    """
+    strides = (shape[1] * shape[2], shape[2], 1)
+    return(np.unique(np.concatenate([n + sign * stride
+                                     for stride in strides
+                                     for sign in (-1, 1)])))
+
+
+def _update(n, K, s2, h2inv, shape):
+    """
+    Return the upwind travel-time update of nodes **n** from the
+    travel times **K** of KNOWN nodes.
+    """
+    ir, it = np.divmod(n // shape[2], shape[1])
+    strides = (shape[1] * shape[2], shape[2], 1)
+    h2inv = (h2inv[0], h2inv[1][ir], h2inv[2][ir, it])
+    b = np.empty((len(n), 3))
+    c = np.empty((len(n), 3))
+    with np.errstate(invalid="ignore"):
+        for axis, stride in enumerate(strides):
+            # Take the upwind side with the smaller travel time, and a
+            # second-order stencil where the next node is also upwind.
+            minus, plus = K[n - stride], K[n + stride]
+            side = np.where(plus < minus, 1, -1) * stride
+            t1 = np.minimum(minus, plus)
+            t2 = K[n + 2 * side]
+            upwind = np.isfinite(t1)
+            second = upwind & (t2 <= t1)
+            b[:, axis] = np.where(second, (4 * t1 - t2) / 3, t1)
+            c[:, axis] = np.where(upwind,
+                                  np.where(second, 2.25, 1.) * h2inv[axis],
+                                  0.)
+    # Solve with the smallest term first, adding larger terms while
+    # the solution exceeds them. Three compare-and-swaps sort the
+    # terms by value.
+    for i, j in ((0, 1), (1, 2), (0, 1)):
+        swap = b[:, j] < b[:, i]
+        b[swap, i], b[swap, j] = b[swap, j], b[swap, i]
+        c[swap, i], c[swap, j] = c[swap, j], c[swap, i]
+    valid = c > 0
+    bz = np.where(valid, b, 0.)
+    A = np.cumsum(c, axis=1)
+    B = np.cumsum(c * bz, axis=1)
+    C = np.cumsum(c * bz ** 2, axis=1)
+    disc = B ** 2 - A * (C - s2[n, None])
+    ok = valid & (disc >= 0)
+    tk = (B + np.sqrt(np.where(ok, disc, 0.))) / np.where(valid, A, 1.)
+    t = np.where(ok[:, 0], tk[:, 0], np.inf)
+    more = ok[:, 0] & valid[:, 1] & (tk[:, 0] > b[:, 1])
+    t = np.where(more & ok[:, 1], tk[:, 1], t)
+    more &= ok[:, 1] & valid[:, 2] & (tk[:, 1] > b[:, 2])
+    return(np.where(more & ok[:, 2], tk[:, 2], t))
+
+
+def write_travel_times(path, velocity, grid, source, phase="P", **kwargs):
+    """
+    Solve for travel times from **source** and write them as a
+    travel-time file readable by :class:`~seispy.ttgrid.TTGrid`.
+
+    Keyword arguments are passed to :func:`solve`.
+
+    :returns: output path
+    :rtype: str
+    """
+    return(_ttgrid.write_ttgrid(path,
+                                grid,
+                                solve(velocity, grid, source, phase=phase,
+                                      **kwargs)))
+
+
+def _cartesian(r, theta, phi):
+    return(np.stack([r * np.sin(theta) * np.cos(phi),
+                     r * np.sin(theta) * np.sin(phi),
+                     r * np.cos(theta)], axis=-1))
+
+
+def _test_grid(shape):
+    from .geogrid import GeoGrid3D
+    nr, nlat, nlon = shape
+    return(GeoGrid3D(33., -117., 0., nlat, nlon, nr,
+                     0.5 / (nlat - 1), 0.5 / (nlon - 1), 40. / (nr - 1)))
+
+
+def accuracy(shape=(21, 31, 31), v0=6., gradient=0.05):
+    """
+    Compare solutions against analytic travel times in a homogeneous
+    model and in a model whose velocity increases linearly with depth
+    below the centre of the grid.
+
+    In the gradient model, v = v0 + g z with z measured along the
+    vertical at the centre of the grid, and the analytic travel time
+    is arccosh(1 + g^2 |x - x0|^2 / (2 v(x) v(x0))) / g.
+
+    :returns: maximum and RMS absolute errors (s) for the homogeneous
+              and gradient models
+    :rtype: dict
+    """
+    grid = _test_grid(shape)
+    R, T, P = grid_coordinates(grid)
+    X = _cartesian(R, T, P)
+    centre = _cartesian(R.max(), T.mean(), P.mean())
+    up = centre / np.linalg.norm(centre)
+    source = (grid.lat0 + 0.3, grid.lon0 + 0.2, 25.)
+    xs = _cartesian(_constants.EARTH_RADIUS - source[2],
+                    np.radians(90. - source[0]),
+                    np.radians(source[1]))
+    dist = np.linalg.norm(X - xs, axis=-1)
+
+    results = {}
+    tt = solve(np.full(R.shape, v0), grid, source)
+    error = tt - dist / v0
+    results["homogeneous"] = (np.abs(error).max(), np.sqrt(np.mean(error**2)))
+
+    def v(x):
+        return(v0 + gradient * np.dot(centre - x, up))
+    vs, vx = v(xs), v(X)
+    analytic = np.arccosh(1 + gradient**2 * dist**2 / (2 * vs * vx)) / gradient
+    tt = solve(vx, grid, source)
+    error = tt - analytic
+    results["gradient"] = (np.abs(error).max(), np.sqrt(np.mean(error**2)))
+    return(results)
+
+
+def benchmark(shape=(41, 61, 61), v0=6.):
+    """
+    Time a solve on a homogeneous model.
+
+    :returns: elapsed time (s) and nodes accepted per second
+    :rtype: (float, float)
+    """
+    grid = _test_grid(shape)
+    source = (grid.lat0 + 0.25, grid.lon0 + 0.25, 10.)
+    velocity = np.full(shape, v0)
+    start = time.perf_counter()
+    solve(velocity, grid, source)
+    elapsed = time.perf_counter() - start
+    return(elapsed, np.prod(shape) / elapsed)
+
+
+if __name__ == "__main__":
+    for model, (emax, erms) in accuracy().items():
+        print("{:12s} max error {:.4f} s, rms error {:.4f} s".format(model,
+                                                                    emax,
+                                                                    erms))
+    elapsed, rate = benchmark()
+    print("solved in {:.2f} s ({:.0f} nodes/s)".format(elapsed, rate))
@@ -1,90 +1,146 @@
 # coding=utf-8
+import io
 import numpy as np
+import pandas as pd
+import scipy.sparse
 from . import constants as _constants
 from . import coords as _coords
 from . import geogrid as _geogrid
+from . import rays as _rays
+from . import surface as _surface
 from . import velocity as _velocity
 
 ER = _constants.EARTH_RADIUS
 
 pi = np.pi
 
+CHUNK_SIZE = 2**20
+
+PATH_DTYPE = [("receiver", np.int64), ("source", np.int64), ("path", np.int64)]
+
 def format_interfaces(interfaces):
-    grid = interfaces[0].grid
-    blob = "{:d}\n".format(len(interfaces))
-    blob += "{:d} {:d}\n".format(grid.nlambda, grid.nphi)
-    blob += "{:.15f} {:.15f}\n".format(np.float64(grid.dlambda), np.float64(grid.dphi))
-    blob += "{:.15f} {:.15f}\n".format(grid.lambda0, grid.phi0)
-    for interface in interfaces:
-        coordinates = np.flipud(interface.coordinates)
-        for (ilambda, iphi) in [(ilambda, iphi) for ilambda in range(grid.nlambda)
-                                  for iphi in range(grid.nphi)]:
-            blob += "{:.15f}\n".format(coordinates[ilambda, iphi, 0])
-    return(blob)
+    return(_format(write_interfaces, interfaces))
 
 def format_propagation_grid(grid):
-    blob = "{:3d} {:3d} {:3d}\n".format(grid.nrho, grid.nlat, grid.nlon)
-    blob += "{:11.6f} {:11.6f} {:11.6f}\n".format(grid.drho, grid.dlat, grid.dlon)
-    blob += "{:11.6f} {:11.6f} {:11.6f}\n".format(-grid.depth0, grid.lat0, grid.lon0)
-    blob += "5 10\n"
-    return(blob)
+    return(_format(write_propagation_grid, grid))
 
 def format_receivers(receivers):
-    blob = "{:d}\n".format(len(receivers))
-    blob += "".join([str(r) for r in receivers])
-    return(blob)
+    return(_format(write_receivers, receivers))
 
 def format_sources(sources):
-    blob = "{:d}\n".format(len(sources))
-    blob += "".join([str(s) for s in sources])
-    return(blob)
-
-def format_vgrids(vmodel):
-    blob = "{:d} {:d}\n".format(vmodel.nvgrids, vmodel.nvtypes)
-    for (typeID, gridID) in [(typeID, gridID)
-                             for typeID in range(1, vmodel.nvtypes + 1)
-                             for gridID in range(1, vmodel.nvgrids+ 1 )]:
-        grid = vmodel.v_type_grids[typeID][gridID]["grid"]
-        blob += "{:d} {:d} {:d}\n".format(grid.nrho,
-                                          grid.nlambda,
-                                          grid.nphi)
-        blob += "{:11.6f} {:11.6f} {:11.6f}\n".format(grid.drho,
-                                                      grid.dlambda,
-                                                      grid.dphi)
-        blob += "{:11.6f} {:11.6f} {:11.6f}\n".format(grid.rho0,
-                                                      grid.lambda0,
-                                                      grid.phi0)
-        for irho, ilambda, iphi in ((i, j, k) for i in range(grid.nrho)
-                                for j in range(grid.nlambda)
-                                for k in range(grid.nphi)):
-            lat, lon, depth = _coords.as_left_spherical([grid.rho0 + irho * grid.drho,
-                                                        grid.lambda0 + ilambda * grid.dlambda,
-                                                        grid.phi0 + iphi * grid.dphi]).to_geographic()
-            blob += "{:11.6f}\n".format(vmodel(typeID, gridID, lat, lon, depth ))
-    return(blob)
+    return(_format(write_sources, sources))
+
+def format_vgrids(vmodel, grids, phases=("P", "S")):
+    return(_format(write_vgrids, vmodel, grids, phases=phases))
+
+def _format(writer, *args, **kwargs):
+    buf = io.StringIO()
+    writer(buf, *args, **kwargs)
+    return(buf.getvalue())
+
+def write_interfaces(outfile, interfaces):
+    """
+    Write interfaces in fm3d interfaces.in format, one interface at a
+    time.
+
+    :param outfile: open text file
+    :param list interfaces: GeoSurfaces sharing one grid
+    """
+    grid = interfaces[0].grid
+    outfile.write("{:d}\n".format(len(interfaces)))
+    outfile.write("{:d} {:d}\n".format(grid.nlambda, grid.nphi))
+    outfile.write("{:.15f} {:.15f}\n".format(np.float64(grid.dlambda),
+                                            np.float64(grid.dphi)))
+    outfile.write("{:.15f} {:.15f}\n".format(grid.lambda0, grid.phi0))
+    for interface in interfaces:
+        radius = np.flipud(interface.coordinates)[:grid.nlambda, :grid.nphi, 0]
+        np.savetxt(outfile, radius.ravel(), fmt="%.15f")
+
+def write_propagation_grid(outfile, grid):
+    outfile.write("{:3d} {:3d} {:3d}\n".format(grid.nrho, grid.nlat, grid.nlon))
+    outfile.write("{:11.6f} {:11.6f} {:11.6f}\n".format(grid.drho,
+                                                        grid.dlat,
+                                                        grid.dlon))
+    outfile.write("{:11.6f} {:11.6f} {:11.6f}\n".format(-grid.depth0,
+                                                        grid.lat0,
+                                                        grid.lon0))
+    outfile.write("5 10\n")
+
+def write_receivers(outfile, receivers):
+    outfile.write("{:d}\n".format(len(receivers)))
+    for receiver in receivers:
+        outfile.write(str(receiver))
+
+def write_sources(outfile, sources):
+    outfile.write("{:d}\n".format(len(sources)))
+    for source in sources:
+        outfile.write(str(source))
+
+def write_vgrids(outfile, vmodel, grids, phases=("P", "S"), chunk_size=2**20):
+    """
+    Write velocity grids in fm3d vgrids.in format.
+
+    Velocities are sampled from **vmodel** for whole blocks of
+    constant-radius slices at once and written block by block, so
+    memory use is bounded by **chunk_size** nodes.
+
+    :param outfile: open text file
+    :param VelocityModel vmodel: velocity model
+    :param grids: grids to sample, each with the *rho*, *lambda* and
+                  *phi* attributes of GeoGrid3D
+    :type grids: GeoGrid3D or list
+    :param tuple phases: phase of each velocity type
+    :param int chunk_size: approximate number of nodes per block
+    """
+    if isinstance(grids, _geogrid.GeoGrid3D):
+        grids = [grids]
+    outfile.write("{:d} {:d}\n".format(len(grids), len(phases)))
+    for phase in phases:
+        for grid in grids:
+            outfile.write("{:d} {:d} {:d}\n".format(grid.nrho,
+                                                    grid.nlambda,
+                                                    grid.nphi))
+            outfile.write("{:11.6f} {:11.6f} {:11.6f}\n".format(grid.drho,
+                                                                grid.dlambda,
+                                                                grid.dphi))
+            outfile.write("{:11.6f} {:11.6f} {:11.6f}\n".format(grid.rho0,
+                                                                grid.lambda0,
+                                                                grid.phi0))
+            theta = pi / 2 - (grid.lambda0 + np.arange(grid.nlambda) * grid.dlambda)
+            phi = grid.phi0 + np.arange(grid.nphi) * grid.dphi
+            nslice = max(1, chunk_size // (grid.nlambda * grid.nphi))
+            for irho in range(0, grid.nrho, nslice):
+                rho = grid.rho0\
+                    + np.arange(irho, min(irho + nslice, grid.nrho)) * grid.drho
+                R, T, P = np.meshgrid(rho, theta, phi, indexing="ij")
+                np.savetxt(outfile,
+                           vmodel.get_velocity(phase, R, T, P).ravel(),
+                           fmt="%11.6f")
 
 def read_interfaces(infile):
-    infile = open(infile)
-    ninter = int(infile.readline().split()[0])
-    nlambda, nphi = [int(v) for v in infile.readline().split()[:2]]
-    dlambda, dphi = [np.float64(v) for v in infile.readline().split()[:2]]
-    lambda0, phi0 = [np.float64(v) for v in infile.readline().split()[:2]]
+    """
+    Read an fm3d interfaces.in file.
+
+    :param str infile: input path
+    :rtype: Interfaces
+    """
+    with open(infile) as inf:
+        ninter = int(inf.readline().split()[0])
+        nlambda, nphi = [int(v) for v in inf.readline().split()[:2]]
+        dlambda, dphi = [np.float64(v) for v in inf.readline().split()[:2]]
+        lambda0, phi0 = [np.float64(v) for v in inf.readline().split()[:2]]
+        radius = pd.read_csv(inf,
+                             sep=r"\s+",
+                             header=None,
+                             usecols=[0],
+                             dtype=np.float64)[0].values
+    if not len(radius) == ninter * nlambda * nphi:
+        raise(ValueError("expected {:d} interface nodes, found {:d}".format(
+                ninter * nlambda * nphi, len(radius))))
     grid = _geogrid.GeoGrid2D(np.degrees(lambda0), np.degrees(phi0),
                              nlambda, nphi,
                              np.degrees(dlambda), np.degrees(dphi))
-    interfaces = []
-    for iinter in range(ninter):
-        surf = _surface.GeoSurface()
-        surf.grid = grid
-        coordinates = _coords.as_left_spherical([[[np.float64(infile.readline().split()[0]),
-                                                  lambda0 + ilambda*dlambda,
-                                                  phi0 + iphi*dphi]
-                                                for iphi in range(nphi)]
-                                                for ilambda in range(nlambda)])
-        coordinates = np.flip(coordinates.to_spherical(), axis=0)
-        surf.coordinates = coordinates
-        interfaces.append(surf)
-    return(interfaces)
+    return(Interfaces(grid, radius.reshape(ninter, nlambda, nphi)))
 
 def read_propgrid(infile):
     infile = open(infile, "r")
@@ -96,19 +152,164 @@ def read_propgrid(infile):
                                     dlat, dlon, dr))
 
 def read_receivers(infile):
-    infile = open(infile)
-    nrec = int(infile.readline().split()[0])
-    receivers = []
-    for irec in range(nrec):
-        depth, lat, lon = [np.float64(v) for v in infile.readline().split()[:3]]
-        lat, lon, depth = _coords.as_geographic([lat, lon, depth])
-        receivers.append(Receiver(lat, lon, depth))
-        npath = int(infile.readline().split()[0])
-        path_sourceID = [int(v) for v in infile.readline().split()[:npath]]
-        pathID = [int(v) for v in infile.readline().split()[:npath]]
-        for ipath in range(npath):
-            receivers[irec].add_path(RayPath(path_sourceID[ipath], pathID[ipath]))
-    return(receivers)
+    """
+    Read an fm3d receivers.in file.
+
+    :param str infile: input path
+    :rtype: Receivers
+    """
+    with open(infile) as inf:
+        nrec = int(inf.readline().split()[0])
+        lines = inf.read().splitlines()[:4*nrec]
+    if not len(lines) == 4 * nrec:
+        raise(ValueError("expected {:d} receivers".format(nrec)))
+    coords = np.loadtxt(lines[0::4], usecols=(0, 1, 2), ndmin=2)
+    npath = np.array([line.split()[0] for line in lines[1::4]], dtype=np.int64)
+    source = np.array(" ".join(lines[2::4]).split(), dtype=np.int64)
+    path = np.array(" ".join(lines[3::4]).split(), dtype=np.int64)
+    if not len(source) == len(path) == npath.sum():
+        raise(ValueError("receiver path lists do not match path counts"))
+    return(Receivers(coords[:, 1], coords[:, 2], coords[:, 0],
+                     npath, source, path))
+
+def _read_chunks(infile, ncols, chunk_size):
+    """
+    Yield whitespace-delimited rows of **infile** in blocks of
+    **chunk_size**, padding short rows with NaN.
+    """
+    return(pd.read_csv(infile,
+                       sep=r"\s+",
+                       header=None,
+                       names=range(ncols),
+                       chunksize=chunk_size))
+
+def _read_flags(column):
+    """
+    Return a column of Fortran logicals (T/F) as booleans.
+    """
+    return(column.astype(str).str.upper().str.startswith("T").values)
+
+def _read_values(chunk, rows, columns):
+    """
+    Return **columns** of the **rows** of a parsed block as float64.
+    Other rows may hold Fortran logicals in the same columns.
+    """
+    return(chunk.loc[rows, columns].to_numpy(dtype=np.float64))
+
+def read_arrivals(infile, chunk_size=CHUNK_SIZE):
+    """
+    Read an fm3d arrivals.dat file, with one "receiver source path
+    time flag" line per arrival.
+
+    :param str infile: input path
+    :param int chunk_size: number of lines parsed at a time
+    :returns: arrivals with *receiver*, *source*, *path*, *time* and
+              *valid* fields
+    :rtype: numpy.ndarray
+    """
+    chunks = []
+    for chunk in _read_chunks(infile, 5, chunk_size):
+        arrivals = np.empty(len(chunk),
+                            dtype=PATH_DTYPE + [("time", np.float64),
+                                                ("valid", np.bool_)])
+        for field in range(3):
+            arrivals[PATH_DTYPE[field][0]] = chunk[field].values
+        arrivals["time"] = chunk[3].values
+        arrivals["valid"] = _read_flags(chunk[4])
+        chunks.append(arrivals)
+    if not chunks:
+        return(np.empty(0, dtype=PATH_DTYPE + [("time", np.float64),
+                                               ("valid", np.bool_)]))
+    return(np.concatenate(chunks))
+
+def read_rays(infile, degrees=False, chunk_size=CHUNK_SIZE):
+    """
+    Read an fm3d rays.dat file. Each ray starts with a five-value
+    "receiver source path nsections tele" line; each of its sections
+    with a four-value header line whose first value is the number of
+    points, followed by one "r lat lon" line per point. Sections are
+    concatenated into a single path per ray. Flags (*tele*, and the
+    section flags) are Fortran logicals, T or F.
+
+    Lines are told apart by their number of values, so the file is
+    parsed in vectorized blocks of **chunk_size** lines.
+
+    :param str infile: input path
+    :param bool degrees: angles in the file are in degrees rather
+                         than radians
+    :param int chunk_size: number of lines parsed at a time
+    :returns: rays indexed by ray, and the (receiver, source, path) and
+              *tele* flag of each ray
+    :rtype: (RaySet, numpy.ndarray)
+    """
+    dtype = PATH_DTYPE + [("tele", np.bool_)]
+    points, owner, index = [], [], []
+    nrays = 0
+    for chunk in _read_chunks(infile, 5, chunk_size):
+        nvalues = chunk.notna().sum(axis=1).values
+        is_ray, is_point = nvalues == 5, nvalues == 3
+        ray = nrays + np.cumsum(is_ray) - 1
+        headers = np.empty(is_ray.sum(), dtype=dtype)
+        values = _read_values(chunk, is_ray, [0, 1, 2]).astype(np.int64)
+        for field in range(3):
+            headers[PATH_DTYPE[field][0]] = values[:, field]
+        headers["tele"] = _read_flags(chunk.loc[is_ray, 4])
+        index.append(headers)
+        points.append(_read_values(chunk, is_point, [0, 1, 2]))
+        owner.append(ray[is_point])
+        nrays += is_ray.sum()
+    points = np.concatenate(points) if points else np.empty((0, 3))
+    owner = np.concatenate(owner) if owner else np.empty(0, dtype=np.int64)
+    index = np.concatenate(index) if index else np.empty(0, dtype=dtype)
+    if degrees:
+        points[:, 1:] = np.radians(points[:, 1:])
+    length = np.bincount(owner, minlength=nrays)
+    return(_rays.RaySet(points, np.cumsum(length) - length, length), index)
+
+def read_frechet(infile, nparams=None, chunk_size=CHUNK_SIZE):
+    """
+    Read an fm3d frechet.dat file into a sparse matrix with one row
+    per ray path and one column per inversion parameter. Each path
+    starts with a four-value "receiver source path nonzero" line,
+    followed by one "parameter derivative" line per non-zero
+    derivative, with parameters numbered from 1.
+
+    The file is parsed in vectorized blocks of **chunk_size** lines,
+    so only the non-zero derivatives are held in memory.
+
+    :param str infile: input path
+    :param int nparams: number of parameters; defaults to the largest
+                        parameter number in the file
+    :param int chunk_size: number of lines parsed at a time
+    :returns: derivatives, and the (receiver, source, path) of each
+              row
+    :rtype: (scipy.sparse.csr_matrix, numpy.ndarray)
+    """
+    rows, cols, data, headers = [], [], [], []
+    npaths = 0
+    for chunk in _read_chunks(infile, 4, chunk_size):
+        nvalues = chunk.notna().sum(axis=1).values
+        is_path, is_value = nvalues == 4, nvalues == 2
+        row = npaths + np.cumsum(is_path) - 1
+        headers.append(_read_values(chunk, is_path, [0, 1, 2]
+                                    ).astype(np.int64))
+        values = _read_values(chunk, is_value, [0, 1])
+        rows.append(row[is_value])
+        cols.append(values[:, 0].astype(np.int64) - 1)
+        data.append(values[:, 1])
+        npaths += is_path.sum()
+    rows, cols, data = [np.concatenate(a) if a else np.empty(0)
+                        for a in (rows, cols, data)]
+    if nparams is None:
+        nparams = int(cols.max()) + 1 if len(cols) else 0
+    index = np.zeros(npaths, dtype=PATH_DTYPE)
+    if headers:
+        headers = np.concatenate(headers)
+        for field in range(3):
+            index[PATH_DTYPE[field][0]] = headers[:, field]
+    frechet = scipy.sparse.csr_matrix((data, (rows, cols)),
+                                      shape=(npaths, nparams))
+    return(frechet, index)
 
 #def read_sources(infile):
 #    infile = open(infile)
@@ -136,6 +337,78 @@ def read_receivers(infile):
 #            sources[-1].add_path(path)
 #    return(sources)
 
+class Interfaces(object):
+    """
+    Array-backed collection of interfaces sharing one grid, as read
+    from an fm3d interfaces.in file.
+
+    Indexing returns a GeoSurface for one interface, built on demand.
+
+    :param GeoGrid2D grid: interface grid
+    :param numpy.ndarray radius: interface radii with shape
+                                 (ninterfaces, nlambda, nphi), with
+                                 latitude increasing along the second
+                                 axis
+    """
+    def __init__(self, grid, radius):
+        self.grid = grid
+        self.radius = radius
+
+    def __len__(self):
+        return(len(self.radius))
+
+    def __getitem__(self, index):
+        surf = _surface.GeoSurface()
+        surf.grid = self.grid
+        surf.coordinates = self.coordinates(index)
+        return(surf)
+
+    def __iter__(self):
+        return(self[i] for i in range(len(self)))
+
+    def coordinates(self, index):
+        """
+        Return spherical coordinates of the nodes of one interface
+        with shape (ntheta, nphi, 3), with theta increasing along the
+        first axis.
+        """
+        grid = self.grid
+        lambda_ = grid.lambda0 + np.arange(grid.nlambda) * grid.dlambda
+        phi = grid.phi0 + np.arange(grid.nphi) * grid.dphi
+        coordinates = np.empty((grid.nlambda, grid.nphi, 3))
+        coordinates[..., 0] = self.radius[index]
+        coordinates[..., 1] = (pi / 2 - lambda_)[:, None]
+        coordinates[..., 2] = phi[None, :]
+        return(_coords.as_spherical(np.flip(coordinates, axis=0)))
+
+class Receivers(object):
+    """
+    Array-backed collection of receivers, as read from an fm3d
+    receivers.in file. Paths of receiver *i* are
+    *source[offset[i]:offset[i]+npath[i]]* and
+    *path[offset[i]:offset[i]+npath[i]]*.
+
+    Indexing returns a Receiver for one receiver, built on demand.
+    """
+    def __init__(self, lat, lon, depth, npath, source, path):
+        self.lat, self.lon, self.depth = lat, lon, depth
+        self.npath = npath
+        self.offset = np.cumsum(npath) - npath
+        self.source, self.path = source, path
+
+    def __len__(self):
+        return(len(self.lat))
+
+    def __getitem__(self, index):
+        receiver = Receiver(self.lat[index], self.lon[index], self.depth[index])
+        start = self.offset[index]
+        for ipath in range(start, start + self.npath[index]):
+            receiver.add_path(RayPath(self.source[ipath], self.path[ipath]))
+        return(receiver)
+
+    def __iter__(self):
+        return(self[i] for i in range(len(self)))
+
 class RayPath(object):
     def __init__(self, sourceID, pathID):
         self.sourceID = sourceID
@@ -204,14 +477,15 @@ def test_io():
     sources = read_sources("%s/sources.in" % rootin)
     interfaces = read_interfaces("%s/interfaces.in" % rootin)
     vmodel = _velocity.VelocityModel("%s/vgrids.in" % rootin, "fmm3d")
+    propgrid = read_propgrid("%s/propgrid.in" % rootin)
     with open("%s/vgrids.in" % rootout, "w") as f:
-        f.write(format_vgrids(vmodel))
+        write_vgrids(f, vmodel, propgrid)
     with open("%s/interfaces.in" % rootout, "w") as f:
-        f.write(format_interfaces(interfaces))
+        write_interfaces(f, interfaces)
     with open("%s/receivers.in" % rootout, "w") as f:
-        f.write(format_receivers(receivers))
+        write_receivers(f, receivers)
     with open("%s/sources.in" % rootout, "w") as f:
-        f.write(format_sources(sources))
+        write_sources(f, sources)
 
 if __name__ == "__main__":
     test_io()
@@ -0,0 +1,324 @@
+# coding=utf-8
+"""
+This module provides a vectorized grid-search earthquake locator
+operating on the nodes of memory-mapped travel-time tables.
+
+.. autoclass:: GridSearchLocator
+   :members:
+"""
+import time as _time
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+from . import constants as _constants
+from ..pandas.io import schema as _schema
+
+NORMS = ("L1", "L2", "EDT")
+
+
+class GridSearchLocator(object):
+    """
+    A coarse-to-fine grid-search locator evaluating the misfit of all
+    candidate :class:`~seispy.core.ttgrid.TTGrid` nodes at once.
+
+    The origin time is eliminated analytically: as the weighted mean
+    of the reduced arrival times for the L2 norm, as their weighted
+    median for the L1 norm, and by differencing arrival pairs for the
+    equal differential-time (EDT) norm.
+
+    :param TTGrid ttgrid: travel-time grid
+    :param str norm: misfit norm - ("L1", "L2", "EDT")
+    :param int stride: node stride of the initial, coarse search;
+                       halved at every refinement until it reaches 1,
+                       after which the search is re-centred until the
+                       minimum lies inside the search window
+    :param numpy.ndarray tensor: stacked travel-time tensor as
+                                 returned by :meth:`TTGrid.stack`;
+                                 tables are read from the memory maps
+                                 if not given
+    :param list keys: (station, phase) pairs matching **tensor**;
+                      defaults to :attr:`TTGrid.keys`
+    :param float conf: confidence level of reported error estimates
+    """
+    def __init__(self, ttgrid, norm="L2", stride=8, tensor=None, keys=None,
+                 conf=0.9):
+        if norm.upper() not in NORMS:
+            raise(ValueError(f"Unrecognized norm - {norm}"))
+        self.ttgrid = ttgrid
+        self.norm = norm.upper()
+        self.stride = max(1, int(stride))
+        self.keys = list(ttgrid.keys if keys is None else keys)
+        self._ikey = {key: ikey for ikey, key in enumerate(self.keys)}
+        self._flat = None if tensor is None\
+            else tensor.transpose(0, 3, 2, 1).reshape(len(tensor), -1)
+        self.conf = conf
+
+    def locate(self, arrival, assoc, min_arrivals=4, auth="seispy"):
+        """
+        Locate every event in a css3.0 **assoc** table.
+
+        Arrival times are taken from **arrival** and joined on *arid*;
+        phases are taken from *assoc.phase*, falling back to
+        *arrival.iphase*. Arrivals without a travel-time table are
+        ignored.
+
+        :param pandas.DataFrame arrival: css3.0 arrival table
+        :param pandas.DataFrame assoc: css3.0 assoc table
+        :param int min_arrivals: minimum number of usable arrivals
+                                 needed to locate an event
+        :param str auth: author recorded in output rows
+        :returns: css3.0 origin and origerr tables
+        :rtype: (pandas.DataFrame, pandas.DataFrame)
+        """
+        df = assoc[["arid", "orid", "sta", "phase"]].merge(
+            arrival[["arid", "time", "iphase"]], on="arid"
+        )
+        df["phase"] = df["phase"].where(df["phase"] != "-", df["iphase"])
+        df["ikey"] = [self._ikey.get(key, -1)
+                      for key in zip(df["sta"], df["phase"])]
+        nass = df.groupby("orid").size()
+        df = df[df["ikey"] >= 0]
+        solutions = []
+        for orid, event in df.groupby("orid"):
+            if len(event) < min_arrivals:
+                continue
+            solution = self.locate_event(event["ikey"].values,
+                                         event["time"].values)
+            solution["orid"] = orid
+            solution["nass"] = nass[orid]
+            solutions.append(solution)
+        return(self._to_tables(solutions, auth))
+
+    def locate_event(self, ikeys, times, weights=None):
+        """
+        Locate a single event.
+
+        :param array-like ikeys: indices into :attr:`keys` of each
+                                 arrival
+        :param array-like times: arrival times
+        :param array-like weights: arrival weights; uniform if not
+                                   given
+        :returns: solution with keys *lat*, *lon*, *depth*, *time*,
+                  *misfit*, *ndef*, *cov* and *sdobs*
+        :rtype: dict
+        """
+        ikeys = np.asarray(ikeys, dtype=np.intp)
+        times = np.asarray(times, dtype=np.float64)
+        weights = np.ones(len(times)) if weights is None\
+            else np.asarray(weights, dtype=np.float64)
+        # Reduce arrival times to preserve float precision.
+        tref = times.min()
+        obs = times - tref
+        ttg = self.ttgrid
+        shape = (ttg.nr, ttg.ntheta, ttg.nphi)
+        stride, center, radius, best = self.stride, None, None, np.inf
+        while True:
+            if center is None:
+                axes = [np.unique(np.append(np.arange(0, n, stride), n - 1))
+                        for n in shape]
+            else:
+                axes = [np.arange(max(0, c - radius),
+                                  min(n - 1, c + radius) + 1,
+                                  stride)
+                        for c, n in zip(center, shape)]
+            IR, ITHETA, IPHI = [I.ravel()
+                                for I in np.meshgrid(*axes, indexing="ij")]
+            index = IR + ttg.nr * (ITHETA + ttg.ntheta * IPHI)
+            misfit, t0 = self._misfit(self._get_tt(ikeys, index),
+                                      obs,
+                                      weights)
+            ibest = np.nanargmin(misfit)
+            improved = misfit[ibest] < best
+            best = misfit[ibest]
+            center = IR[ibest], ITHETA[ibest], IPHI[ibest]
+            if stride == 1:
+                # A minimum on the edge of the search window, but not
+                # of the grid, may not be the local minimum; re-centre
+                # on it and search again while the misfit decreases.
+                edge = any(c in (axis[0], axis[-1]) and 0 < c < n - 1
+                           for c, axis, n in zip(center, axes, shape))
+                if not edge or not improved:
+                    break
+                continue
+            radius, stride = stride, max(1, stride // 2)
+        irb, ithetab, iphib = center
+        r = ttg.r0 + irb * ttg.dr
+        theta = ttg.theta0 - ithetab * ttg.dtheta
+        # Node offsets from the solution in km (east, north, down) and
+        # seconds, used to estimate the covariance matrix.
+        offset = np.stack([(IPHI - iphib) * ttg.dphi * r * np.sin(theta),
+                           (ITHETA - ithetab) * ttg.dtheta * r,
+                           (irb - IR) * ttg.dr,
+                           t0 - t0[ibest]])
+        ndef = len(obs)
+        sdobs = self._sdobs(misfit[ibest], weights, ndef)
+        return({"lat": ttg.lat0 + ithetab * ttg.dlat,
+                "lon": ttg.lon0 + iphib * ttg.dlon,
+                "depth": _constants.EARTH_RADIUS - r,
+                "time": tref + t0[ibest],
+                "misfit": misfit[ibest],
+                "ndef": ndef,
+                "sdobs": sdobs,
+                "cov": self._covariance(misfit - misfit[ibest],
+                                        offset,
+                                        sdobs)})
+
+    def _get_tt(self, ikeys, index):
+        if self._flat is not None:
+            return(self._flat[ikeys[None, :], index[:, None]]
+                   .astype(np.float64))
+        tt = np.empty((len(index), len(ikeys)))
+        for iarr, ikey in enumerate(ikeys):
+            tt[:, iarr] = self.ttgrid._get_flat(*self.keys[ikey])[index]
+        return(tt)
+
+    def _misfit(self, tt, obs, weights):
+        """
+        Return the misfit and optimal origin time of every node given
+        an (nnodes, narrivals) array of travel times.
+        """
+        d = obs[None, :] - tt
+        if self.norm == "L2":
+            t0 = d @ (weights / weights.sum())
+            return(np.square(d - t0[:, None]) @ weights, t0)
+        t0 = _weighted_median(d, weights)
+        if self.norm == "L1":
+            return(np.abs(d - t0[:, None]) @ weights, t0)
+        i, j = np.triu_indices(len(obs), k=1)
+        wpair = weights[i] * weights[j]
+        misfit = np.empty(len(d))
+        # Bound memory use of the (nnodes, npairs) differences.
+        chunk = max(1, 2 ** 22 // max(1, len(i)))
+        for start in range(0, len(d), chunk):
+            dd = d[start:start+chunk]
+            misfit[start:start+chunk] = np.abs(dd[:, i] - dd[:, j]) @ wpair
+        return(misfit, t0)
+
+    def _sdobs(self, misfit, weights, ndef):
+        if self.norm == "L2":
+            return(np.sqrt(misfit / weights.sum() * ndef / max(1, ndef - 4)))
+        if self.norm == "L1":
+            return(misfit / weights.sum())
+        return(misfit / max(1, ndef * (ndef - 1) // 2))
+
+    def _covariance(self, dmisfit, offset, sdobs):
+        """
+        Return the (east, north, down, time) covariance implied by the
+        misfit surface in the neighbourhood of the solution.
+        """
+        if not sdobs > 0:
+            return(np.zeros((4, 4)))
+        if self.norm == "L2":
+            p = np.exp(-dmisfit / (2 * sdobs ** 2))
+        else:
+            p = np.exp(-dmisfit / sdobs)
+        p = np.where(np.isfinite(p), p, 0)
+        p /= p.sum()
+        offset = np.where(np.isfinite(offset), offset, 0)
+        mean = offset @ p
+        offset = offset - mean[:, None]
+        return((offset * p) @ offset.T)
+
+    def _to_tables(self, solutions, auth):
+        origin = pd.concat([_schema.get_null("css3.0", "origin")]
+                           * len(solutions),
+                           ignore_index=True)
+        origerr = pd.concat([_schema.get_null("css3.0", "origerr")]
+                            * len(solutions),
+                            ignore_index=True)
+        if len(solutions) == 0:
+            return(origin, origerr)
+        lddate = _time.time()
+        for field in ("lat", "lon", "depth", "time", "orid", "nass", "ndef"):
+            origin[field] = [solution[field] for solution in solutions]
+        origin["jdate"] = pd.to_datetime(origin["time"], unit="s"
+                                         ).dt.strftime("%Y%j").astype(int)
+        origin["algorithm"] = f"gridsearch:{self.norm.lower()}"
+        origin["auth"] = auth
+        origin["lddate"] = lddate
+        cov = np.stack([solution["cov"] for solution in solutions])
+        origerr["orid"] = origin["orid"]
+        for field, (i, j) in (("sxx", (0, 0)), ("syy", (1, 1)),
+                              ("szz", (2, 2)), ("stt", (3, 3)),
+                              ("sxy", (0, 1)), ("sxz", (0, 2)),
+                              ("syz", (1, 2)), ("stx", (3, 0)),
+                              ("sty", (3, 1)), ("stz", (3, 2))):
+            origerr[field] = cov[:, i, j]
+        origerr["sdobs"] = [solution["sdobs"] for solution in solutions]
+        # Error ellipse of the horizontal covariance.
+        k2 = np.sqrt(scipy.stats.chi2.ppf(self.conf, 2))
+        k1 = np.sqrt(scipy.stats.chi2.ppf(self.conf, 1))
+        eigval, eigvec = np.linalg.eigh(cov[:, :2, :2])
+        origerr["smajax"] = k2 * np.sqrt(np.maximum(eigval[:, 1], 0))
+        origerr["sminax"] = k2 * np.sqrt(np.maximum(eigval[:, 0], 0))
+        origerr["strike"] = np.degrees(np.arctan2(eigvec[:, 0, 1],
+                                                  eigvec[:, 1, 1])) % 180
+        origerr["sdepth"] = k1 * np.sqrt(np.maximum(cov[:, 2, 2], 0))
+        origerr["stime"] = k1 * np.sqrt(np.maximum(cov[:, 3, 3], 0))
+        origerr["conf"] = self.conf
+        origerr["lddate"] = lddate
+        return(origin, origerr)
+
+
+def _weighted_median(d, weights):
+    """
+    Return the weighted median of each row of **d**.
+    """
+    isort = np.argsort(d, axis=1)
+    w = weights[isort]
+    cw = np.cumsum(w, axis=1)
+    imed = np.argmax(cw >= 0.5 * cw[:, -1:], axis=1)
+    imed = np.take_along_axis(isort, imed[:, None], axis=1)
+    return(np.take_along_axis(d, imed, axis=1)[:, 0])
+
+
+def benchmark(ttgrid, nevents=100, narrivals=None, norm="L2", stride=8,
+              stacked=True, seed=0):
+    """
+    Locate synthetic events drawn from the nodes of **ttgrid** and
+    return the throughput in events per second.
+
+    :param TTGrid ttgrid: travel-time grid
+    :param int nevents: number of synthetic events
+    :param int narrivals: number of arrivals per event; defaults to
+                          all station/phase pairs
+    :param str norm: misfit norm
+    :param int stride: coarse-search node stride
+    :param bool stacked: locate using an in-memory stacked tensor
+    :param int seed: random seed
+    :returns: events located per second
+    :rtype: float
+    """
+    rng = np.random.default_rng(seed)
+    keys = ttgrid.keys
+    narrivals = len(keys) if narrivals is None else min(narrivals, len(keys))
+    locator = GridSearchLocator(ttgrid,
+                                norm=norm,
+                                stride=stride,
+                                tensor=ttgrid.stack() if stacked else None)
+    events = []
+    for ievent in range(nevents):
+        ikeys = rng.choice(len(keys), size=narrivals, replace=False)
+        index = rng.integers(ttgrid.nr * ttgrid.ntheta * ttgrid.nphi)
+        times = np.array([ttgrid._get_flat(*keys[ikey])[index]
+                          for ikey in ikeys], dtype=np.float64)
+        events.append((ikeys, times + rng.normal(scale=0.01,
+                                                 size=narrivals)))
+    start = _time.perf_counter()
+    for ikeys, times in events:
+        locator.locate_event(ikeys, times)
+    elapsed = _time.perf_counter() - start
+    rate = nevents / elapsed
+    print(f"{norm}: located {nevents} events with {narrivals} arrivals in "
+          f"{elapsed:.3f} s ({rate:.1f} events/s/core)")
+    return(rate)
+
+
+if __name__ == "__main__":
+    import sys
+    from . import ttgrid as _ttgrid
+    ttg = _ttgrid.TTGrid(sys.argv[1])
+    for norm in NORMS:
+        benchmark(ttg, norm=norm)
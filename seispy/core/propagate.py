@@ -1,51 +1,181 @@
 # coding=utf-8
+import concurrent.futures
+import hashlib
+import os
 import numpy as np
 import seispy
-import fmm3d
+import fmm3d as fm3d
+
+from . import atomic as _atomic
+from . import rays as _rays
+from .rays import RaySet
+
+MAXPTS = 10000
+# Upper bound on the size in bytes of the dense ray buffer fm3d fills.
+RAY_BUFFER_SIZE = 2 ** 28
+SETUP_VERSION = 1
+
 
 class Propagator(seispy.velocity.VelocityModel):
-    def __init__(self, *args, **kwargs):
+    """
+    Wavefront propagator built on fm3d.
+
+    Preparing the model for fm3d (regularizing, padding and fitting
+    the propagation grid) is deterministic, so with **cache_dir** set
+    the prepared grids are stored in a file named after a hash of the
+    model arrays, topography and parameters, and reused by later
+    instances built from the same inputs.
+
+    :param str cache_dir: directory for cached setups
+    :param float pad_depth: depth (km) to pad the model to
+    """
+    def __init__(self, *args, cache_dir=None, pad_depth=30, **kwargs):
         super().__init__(*args, **kwargs)
-        self.regularize(self.nodes["nr"],
-                        self.nodes["ntheta"],
-                        self.nodes["nphi"])
-        self.pad(depth=30)
-        self.pgrid = self.fit_propagation_grid()
-        self.vgrids = np.array(
-                [np.stack((np.fliplr(np.copy(self.values["Vp"])),
-                           np.fliplr(np.copy(self.values["Vs"]))))]
-                              )
-        fm3d.initialize_propagation_grid(**self.pgrid)
-        fm3d.initialize_velocity_grids(self.vgrids,
-                                       *self.vgrids.shape,
-                                       self.nodes["r_min"],
-                                       np.pi/2 - self.nodes["theta_max"],
-                                       self.nodes["phi_min"],
-                                       self.nodes["dr"],
-                                       self.nodes["dtheta"],
-                                       self.nodes["dphi"])
-        fm3d.initialize_interfaces(np.pi/2 - self.nodes["theta_max"],
-                                   self.nodes["phi_min"],
-                                   self.nodes["ntheta"],
-                                   self.nodes["nphi"],
-                                   self.nodes["dtheta"],
-                                   self.nodes["dphi"])
-
-    def __call__(self, sources, receivers):
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir,
+                                self._setup_key(pad_depth) + ".npz")
+        if path is not None and os.path.exists(path):
+            self._load_setup(path)
+        else:
+            self.regularize(self.nodes["nr"],
+                            self.nodes["ntheta"],
+                            self.nodes["nphi"])
+            self.pad(depth=pad_depth)
+            self.pgrid = self.fit_propagation_grid()
+            self.vgrids = np.array(
+                    [np.stack((np.fliplr(np.copy(self.values["Vp"])),
+                               np.fliplr(np.copy(self.values["Vs"]))))]
+                                  )
+            if path is not None:
+                self._save_setup(path)
+        _initialize_fm3d(self._fm3d_setup())
+
+    def _setup_key(self, pad_depth):
+        """
+        Return a hex digest identifying the prepared setup of this
+        model.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((SETUP_VERSION, pad_depth)).encode())
+        for name, fields in (("nodes", self.nodes), ("values", self.values)):
+            for key in sorted(fields):
+                _hash_array(digest, f"{name}/{key}", fields[key])
+        if hasattr(self.topo, "radius"):
+            for key in ("theta", "phi", "radius"):
+                _hash_array(digest, f"topo/{key}", getattr(self.topo, key))
+        else:
+            lat = 90 - np.degrees(self.nodes["theta"][0, :, 0])
+            lon = np.degrees(self.nodes["phi"][0, 0, :])
+            _hash_array(digest,
+                        "topo",
+                        [[self.topo(_lat, _lon) for _lon in lon]
+                         for _lat in lat])
+        return(digest.hexdigest())
+
+    def _save_setup(self, path):
+        """
+        Atomically write the prepared setup to **path**.
+        """
+        arrays = {"vgrids": self.vgrids}
+        for name, fields in (("nodes", self.nodes),
+                             ("values", self.values),
+                             ("pgrid", self.pgrid)):
+            arrays.update({f"{name}/{key}": value
+                           for key, value in fields.items()})
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with _atomic.AtomicFile(path, "wb") as outf:
+            np.savez(outf, **arrays)
+
+    def _load_setup(self, path):
+        """
+        Restore a setup written by :meth:`_save_setup`.
+        """
+        self.nodes, self.values, self.pgrid = {}, {}, {}
+        with np.load(path) as npz:
+            self.vgrids = npz["vgrids"]
+            for name in npz.files:
+                if name == "vgrids":
+                    continue
+                field, key = name.split("/", 1)
+                value = npz[name]
+                getattr(self, field)[key] = value.item() if value.ndim == 0\
+                                                         else value
+
+    def __call__(self, sources, receivers, nprocs=None, batch_size=None,
+                 mp_context=None, reciprocal=False, rays=True):
+        """
+        Propagate wavefronts from every source and return rays and
+        travel times at every receiver.
+
+        With **nprocs** > 1, sources are split into batches of
+        **batch_size** and handed out to a pool of worker processes,
+        each of which initializes its own fm3d propagation grid once.
+
+        Rays are trimmed to their real length as each source
+        finishes, so memory scales with the number of ray points
+        rather than with a fixed buffer per source-receiver pair. Use
+        :meth:`RaySet.to_masked` for the old dense masked layout.
+
+        With **reciprocal** set, wavefronts are propagated from the
+        receivers and sampled at the sources instead, which is much
+        cheaper when there are far fewer receivers than sources.
+        Outputs are transposed, and rays reversed, so that they are
+        oriented exactly as in the forward mode.
+
+        :param array-like sources: geographic source coordinates
+        :param array-like receivers: geographic receiver coordinates
+        :param int nprocs: number of worker processes
+        :param int batch_size: number of sources per batch; defaults
+                               to about four batches per process
+        :param mp_context: multiprocessing context for the pool
+        :param bool reciprocal: propagate from receivers to sources
+        :param bool rays: return rays; if False, fm3d is given a
+                          one-point ray buffer, so that memory does not
+                          grow with the number of rays, and None is
+                          returned in their place
+        :returns: rays indexed by (source, receiver, phase) and
+                  travel times with shape (nsources, nreceivers, 2)
+        :rtype: (RaySet, numpy.ndarray)
+        """
         sources = seispy.geometry.validate_geographic_coords(sources)
-        nsources = len(sources)
         receivers = seispy.geometry.validate_geographic_coords(receivers)
-        nreceivers = len(receivers)
-        rays = np.zeros((nsources, nreceivers, 2, 10000, 3),
-                            order="F",
-                            dtype=np.float32) - 999.
-        tts = np.empty((nsources, nreceivers, 2),
-                        order="F",
-                        dtype=np.float32)
-        fm3d.run(sources, nsources, receivers, nreceivers, rays, tts)
-        rays = np.ma.masked_equal(rays, -999.)
+        if reciprocal:
+            sources, receivers = receivers, sources
+        if nprocs is None or nprocs <= 1 or len(sources) <= 1:
+            rays, tts = _run(sources, receivers, rays=rays)
+        else:
+            if batch_size is None:
+                batch_size = max(1, -(-len(sources) // (4 * nprocs)))
+            batches = [(sources[i:i+batch_size], receivers, rays)
+                       for i in range(0, len(sources), batch_size)]
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=nprocs,
+                    mp_context=mp_context,
+                    initializer=_initialize_fm3d,
+                    initargs=(self._fm3d_setup(),)
+            ) as pool:
+                results = list(pool.map(_run_batch, batches))
+            rays = RaySet.concatenate([r for r, _ in results]) if rays else None
+            tts = np.asfortranarray(np.concatenate([t for _, t in results]))
+        if reciprocal:
+            tts = np.asfortranarray(tts.transpose(1, 0, 2))
+            if rays is not None:
+                rays = rays.transpose()
         return(rays, tts)
 
+    def _fm3d_setup(self):
+        """
+        Return everything needed to initialize fm3d for this model in
+        another process.
+        """
+        return({"pgrid": self.pgrid,
+                "vgrids": self.vgrids,
+                "nodes": {key: self.nodes[key]
+                          for key in ("r_min", "theta_max", "phi_min",
+                                      "dr", "dtheta", "dphi",
+                                      "ntheta", "nphi")}})
+
     def fit_propagation_grid(self,
                              nr=None,
                              nlat=None,
@@ -104,6 +234,83 @@ class Propagator(seispy.velocity.VelocityModel):
         R, T, P = np.meshgrid(r_nodes, t_nodes, p_nodes, indexing="ij")
         self.regrid(R, T, P)
 
+def _initialize_fm3d(setup):
+    """
+    Initialize the global fm3d propagation grid, velocity grids and
+    interfaces of the current process.
+    """
+    nodes, vgrids = setup["nodes"], setup["vgrids"]
+    fm3d.initialize_propagation_grid(**setup["pgrid"])
+    fm3d.initialize_velocity_grids(vgrids,
+                                   *vgrids.shape,
+                                   nodes["r_min"],
+                                   np.pi/2 - nodes["theta_max"],
+                                   nodes["phi_min"],
+                                   nodes["dr"],
+                                   nodes["dtheta"],
+                                   nodes["dphi"])
+    fm3d.initialize_interfaces(np.pi/2 - nodes["theta_max"],
+                               nodes["phi_min"],
+                               nodes["ntheta"],
+                               nodes["nphi"],
+                               nodes["dtheta"],
+                               nodes["dphi"])
+
+def _hash_array(digest, name, array):
+    array = np.ascontiguousarray(array)
+    digest.update(f"{name}:{array.dtype.str}:{array.shape}".encode())
+    digest.update(array.tobytes())
+
+def _run(sources, receivers, rays=True):
+    """
+    Run fm3d one source at a time, reusing dense ray buffers and
+    keeping only the trimmed rays.
+
+    A dense buffer holds MAXPTS points per ray, about 240 kB per
+    receiver, so receivers are passed to fm3d in blocks small enough
+    to keep it within RAY_BUFFER_SIZE bytes; each block repeats the
+    propagation. Without rays the buffer holds a single point per ray
+    and every receiver fits in one block, so memory grows only with
+    the travel times however many receivers there are, as in
+    reciprocal mode with many events.
+    """
+    nsources, nreceivers = len(sources), len(receivers)
+    npts = MAXPTS if rays else 1
+    block_size = max(1, RAY_BUFFER_SIZE // (2 * npts * 3 * 4))
+    tts = np.empty((nsources, nreceivers, 2),
+                    order="F",
+                    dtype=np.float32)
+    buffers = {}
+    raysets = []
+    for isrc in range(nsources):
+        blocks = []
+        for irx in range(0, nreceivers, block_size):
+            block = receivers[irx:irx+block_size]
+            nblock = len(block)
+            if nblock not in buffers:
+                buffers[nblock] = (np.empty((1, nblock, 2, npts, 3),
+                                            order="F",
+                                            dtype=np.float32),
+                                   np.empty((1, nblock, 2),
+                                            order="F",
+                                            dtype=np.float32))
+            buf, tt = buffers[nblock]
+            buf[...] = -999.
+            fm3d.run(sources[isrc:isrc+1], 1, block, nblock, buf, tt)
+            tts[isrc, irx:irx+nblock] = tt[0]
+            if rays:
+                blocks.append(RaySet.from_dense(buf[0]))
+        if rays:
+            # Blocks are concatenated along the receiver axis.
+            rayset = RaySet.concatenate(blocks)
+            raysets.append(RaySet(rayset.points,
+                                  rayset.offset[np.newaxis],
+                                  rayset.length[np.newaxis]))
+    return(RaySet.concatenate(raysets) if rays else None, tts)
+
+def _run_batch(batch):
+    return(_run(*batch))
+
 def write_sources(sources):
     outf = open("/Users/malcolcw/Desktop/rays/sources.rtp", "w")
     for sx in sources:
@@ -118,25 +325,12 @@ def write_receivers(receivers):
         outf.write("{:.6f} {:.6f} {:.6f}\n".format(r, t, p))
     outf.close()
 
-def write_rays(rays):
-    outfP = open("/Users/malcolcw/Desktop/rays/rays-P.rtp", "w")
-    outfS = open("/Users/malcolcw/Desktop/rays/rays-S.rtp", "w")
-    outfP.write("{:d}\n".format(rays.shape[0]*rays.shape[1]))
-    outfS.write("{:d}\n".format(rays.shape[0]*rays.shape[1]))
-    for sx in rays:
-        for rayP, rayS in sx:
-            outfP.write("{:d}\n".format(len([px for px in rayP if not np.any(px.mask)])))
-            outfS.write("{:d}\n".format(len([px for px in rayS if not np.any(px.mask)])))
-            rayP[:,1] *= -1
-            rayP[:,1] += np.pi / 2
-            rayS[:,1] *= -1
-            rayS[:,1] += np.pi / 2
-            for px in np.array([px for px in rayP if not np.any(px.mask)]):
-                outfP.write("{:.6f} {:.6f} {:.6f}\n".format(*px))
-            for px in np.array([px for px in rayS if not np.any(px.mask)]):
-                outfS.write("{:.6f} {:.6f} {:.6f}\n".format(*px))
-    outfP.close()
-    outfS.close()
+def write_rays(path, rays, text=False):
+    """
+    Write rays returned by :class:`Propagator` to **path**, indexed by
+    (source, receiver, phase); see :class:`seispy.rays.RayWriter`.
+    """
+    return(_rays.write_rays(path, rays, text=text))
 
 if __name__ == "__main__":
     prop = Propagator("/Users/malcolcw/Projects/Shared/Velocity/FANG2016/original/VpVs.dat", "fang", topo=seispy.topography.Topography("/Users/malcolcw/Projects/Shared/Topography/anza.xyz"))
@@ -157,10 +351,10 @@ if __name__ == "__main__":
                        [lat0 + 0.25*dlat, lon0 + 0.25*dlon],
                        [lat0 - 0.25*dlat, lon0 + 0.25*dlon]]
 
-    receivers[:,2] = np.array([prop.topo(*receivers[i,:2]) - seispy.constants.EARTH_RADIUS
-                                for i in range(len(receivers))])
+    receivers[:,2] = prop.topo(receivers[:,0], receivers[:,1])\
+                   - seispy.constants.EARTH_RADIUS
     rays, tts = prop(sources, receivers)
     #plot(rays)
-    write_rays(rays)
+    write_rays("/Users/malcolcw/Desktop/rays/rays.bin", rays)
     write_sources(sources)
     write_receivers(receivers)
@@ -0,0 +1,714 @@
+# coding=utf-8
+"""
+Ray paths: a compact ragged container, streaming ray files and a
+vectorized pseudo-bending ray tracer.
+
+.. autoclass:: RaySet
+   :members:
+
+.. autoclass:: RayWriter
+   :members:
+
+.. autoclass:: Coverage
+   :members:
+
+.. autofunction:: write_rays
+.. autofunction:: read_rays
+.. autofunction:: bend
+"""
+import io
+import os
+import struct
+import time
+
+import numpy as np
+
+from . import atomic as _atomic
+from . import constants as _constants
+
+MAGIC = b"RAY1"
+_PREAMBLE = "<4si"
+
+
+class RaySet(object):
+    """
+    A ragged collection of rays, indexed by (source, receiver, phase)
+    for rays from :class:`~seispy.propagate.Propagator` or by pair for
+    rays from :func:`bend`.
+
+    Points of every ray are stored back to back in a single
+    (npoints, 3) array; **offset** and **length** give the first
+    point and number of points of each ray. Points are (r, latitude,
+    longitude) with angles in radians, as returned by fm3d.
+
+    :param numpy.ndarray points: ray points with shape (npoints, 3)
+    :param numpy.ndarray offset: index of the first point of each ray,
+                                 e.g. with shape (nsources,
+                                 nreceivers, 2)
+    :param numpy.ndarray length: number of points in each ray with
+                                 the same shape as **offset**
+    """
+    def __init__(self, points, offset, length):
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        self.offset = np.asarray(offset, dtype=np.int64)
+        self.length = np.asarray(length, dtype=np.int64)
+        if self.offset.shape != self.length.shape:
+            raise(ValueError("offset and length shapes do not match"))
+
+    def __getitem__(self, index):
+        offset, length = self.offset[index], self.length[index]
+        if np.ndim(offset) != 0:
+            raise(IndexError("index must select a single ray"))
+        return(self.points[offset:offset+length])
+
+    def __len__(self):
+        return(len(self.offset))
+
+    @property
+    def shape(self):
+        return(self.offset.shape)
+
+    @classmethod
+    def from_dense(cls, rays, fill=-999.):
+        """
+        Build a RaySet from a dense (..., npts, 3) buffer padded with
+        **fill**, trimming every ray to its real length.
+        """
+        valid = np.asarray(rays)[..., 0] != fill
+        length = valid.sum(axis=-1)
+        offset = np.cumsum(length.ravel()) - length.ravel()
+        return(cls(np.asarray(rays)[valid],
+                   offset.reshape(length.shape),
+                   length))
+
+    @classmethod
+    def concatenate(cls, raysets):
+        """
+        Concatenate RaySets along the source axis.
+        """
+        raysets = list(raysets)
+        shift = np.cumsum([0] + [len(rs.points) for rs in raysets[:-1]])
+        return(cls(np.concatenate([rs.points for rs in raysets]),
+                   np.concatenate([rs.offset + s
+                                   for rs, s in zip(raysets, shift)]),
+                   np.concatenate([rs.length for rs in raysets])))
+
+    def _point_index(self):
+        """
+        Return the index into **points** of every point of every ray,
+        in ray order, with the ray start and position within the ray.
+        """
+        length = self.length.ravel()
+        start = np.repeat(self.offset.ravel(), length)
+        within = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length,
+                                                     length)
+        return(start + within, start, within)
+
+    def compact(self):
+        """
+        Return a RaySet whose points are stored contiguously in ray
+        order with no gaps.
+        """
+        index, _, _ = self._point_index()
+        length = self.length
+        offset = (np.cumsum(length.ravel()) - length.ravel()).reshape(length.shape)
+        return(RaySet(self.points[index], offset, length))
+
+    def transpose(self):
+        """
+        Swap the source and receiver axes and reverse every ray so
+        that it runs from the new source to the new receiver.
+        """
+        length = self.length.ravel()
+        _, start, within = self._point_index()
+        points = self.points.copy()
+        points[start + within] = self.points[start
+                                             + np.repeat(length, length)
+                                             - 1
+                                             - within]
+        return(RaySet(points,
+                      self.offset.swapaxes(0, 1),
+                      self.length.swapaxes(0, 1)))
+
+    def to_masked(self, npts=None):
+        """
+        Return rays as a dense masked array with shape
+        (nsources, nreceivers, 2, **npts**, 3).
+
+        :param int npts: number of points per ray; defaults to the
+                         length of the longest ray
+        """
+        if npts is None:
+            npts = int(self.length.max()) if self.length.size else 0
+        length = np.minimum(self.length, npts)
+        rays = np.full(self.shape + (npts, 3), -999., dtype=np.float32)
+        valid = np.arange(npts) < length[..., np.newaxis]
+        index = (self.offset[..., np.newaxis] + np.arange(npts))[valid]
+        rays[valid] = self.points[index]
+        return(np.ma.masked_equal(rays, -999.))
+
+    def save(self, outfile):
+        """
+        Save to an uncompressed .npz file.
+        """
+        np.savez(outfile,
+                 points=self.points,
+                 offset=self.offset,
+                 length=self.length)
+
+    @classmethod
+    def load(cls, infile):
+        """
+        Load a RaySet saved with :meth:`save`.
+        """
+        with np.load(infile) as npz:
+            return(cls(npz["points"], npz["offset"], npz["length"]))
+
+
+
+class RayWriter(object):
+    """
+    Streaming writer of ray files.
+
+    Rays are written in chunks along the first (source) axis, in
+    order. Binary files hold a preamble with the ray-index shape,
+    the float32 points of every ray back to back, and a trailing index
+    of ray offsets and lengths, so that :func:`read_rays` can memory-map
+    them and access any ray directly.
+
+    Text output keeps the legacy .rtp layout of one file per phase,
+    the last axis of the ray index, named by inserting "-<phase>"
+    before the extension of **path** (e.g. rays-P.rtp and rays-S.rtp
+    for rays.rtp). Each file holds one ray count line, then for each
+    ray its number of points followed by one "r theta phi" line per
+    point, with theta the colatitude.
+
+    Files are written to temporary names and moved into place only
+    when complete.
+
+    :param str path: output path
+    :param tuple shape: shape of the ray index, e.g. (nsources,
+                        nreceivers, 2)
+    :param bool text: write text instead of binary
+    :param tuple phases: names of the phases along the last axis of
+                         the ray index, used to name text files
+    """
+    def __init__(self, path, shape, text=False, phases=("P", "S")):
+        self.path = os.path.abspath(path)
+        self.shape = tuple(int(n) for n in shape)
+        self.text = text
+        self.nwritten = 0
+        self.npoints = 0
+        self._offset, self._length = [], []
+        if text:
+            if not len(phases) == self.shape[-1]:
+                raise(ValueError("phases do not match the last axis of the "
+                                 "ray index"))
+            root, ext = os.path.splitext(self.path)
+            self.paths = ["{}-{}{}".format(root, phase, ext)
+                          for phase in phases]
+            self._atomic = [_atomic.AtomicFile(path, "w")
+                            for path in self.paths]
+            for outfile in self._atomic:
+                outfile.file.write("{:d}\n".format(
+                    int(np.prod(self.shape[:-1]))))
+        else:
+            self.paths = [self.path]
+            self._atomic = [_atomic.AtomicFile(self.path, "wb")]
+            self._outfile = self._atomic[0].file
+            self._outfile.write(struct.pack(_PREAMBLE, MAGIC, len(self.shape)))
+            self._outfile.write(np.array(self.shape, dtype="<i8").tobytes())
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rays):
+        """
+        Write the next chunk of rays. The input is not modified.
+
+        :param rays: rays with index shape (k,) + shape[1:]
+        :type rays: RaySet, or a dense (masked) array padded with -999
+        """
+        if not isinstance(rays, RaySet):
+            if isinstance(rays, np.ma.MaskedArray):
+                rays = rays.filled(-999.)
+            rays = RaySet.from_dense(rays)
+        if not rays.shape[1:] == self.shape[1:]\
+                or self.nwritten + rays.shape[0] > self.shape[0]:
+            raise(ValueError("ray chunk does not match file shape"))
+        rays = rays.compact()
+        if self.text:
+            self._write_text(rays)
+        else:
+            self._outfile.write(np.ascontiguousarray(rays.points,
+                                                     dtype="<f4").tobytes())
+        self._offset.append(rays.offset.ravel() + self.npoints)
+        self._length.append(rays.length.ravel())
+        self.npoints += len(rays.points)
+        self.nwritten += rays.shape[0]
+
+    def _write_text(self, rays):
+        points = rays.points.astype(np.float64)
+        points[:, 1] = np.pi / 2 - points[:, 1]
+        buf = io.StringIO()
+        np.savetxt(buf, points, fmt="%.6f")
+        lines = buf.getvalue().splitlines(keepends=True)
+        for iphase, outfile in enumerate(self._atomic):
+            offset = rays.offset[..., iphase].ravel().tolist()
+            length = rays.length[..., iphase].ravel().tolist()
+            for start, n in zip(offset, length):
+                outfile.file.write("{:d}\n".format(n))
+                outfile.file.writelines(lines[start:start+n])
+
+    def close(self):
+        """
+        Finish the files and move them into place.
+        """
+        if self._atomic is None:
+            return
+        if not self.nwritten == self.shape[0]:
+            self.abort()
+            raise(ValueError("ray file incomplete: {:d} of {:d} rows "
+                             "written".format(self.nwritten, self.shape[0])))
+        if not self.text:
+            for index in (self._offset, self._length):
+                self._outfile.write(np.concatenate(index)
+                                      .astype("<i8")
+                                      .tobytes())
+            self._outfile.write(struct.pack("<q", self.npoints))
+        for outfile in self._atomic:
+            outfile.commit()
+        self._atomic = None
+
+    def abort(self):
+        """
+        Discard the partially written files.
+        """
+        if self._atomic is None:
+            return
+        for outfile in self._atomic:
+            outfile.discard()
+        self._atomic = None
+
+
+def write_rays(path, rays, text=False):
+    """
+    Write rays to **path**; see :class:`RayWriter`.
+
+    :param str path: output path
+    :param rays: rays
+    :type rays: RaySet, or a dense (masked) array padded with -999
+    :param bool text: write text instead of binary
+    :returns: output path, or the list of per-phase paths for text
+              output
+    :rtype: str or list
+    """
+    shape = rays.shape if isinstance(rays, RaySet) else rays.shape[:-2]
+    with RayWriter(path, shape, text=text) as writer:
+        writer.write(rays)
+    return(writer.paths if text else writer.path)
+
+
+def read_rays(path):
+    """
+    Open a binary ray file written by :class:`RayWriter`. Points are
+    memory-mapped, so individual rays are read from disk only when
+    accessed.
+
+    :param str path: input path
+    :rtype: RaySet
+    """
+    with open(path, "rb") as infile:
+        magic, ndim = struct.unpack(_PREAMBLE,
+                                    infile.read(struct.calcsize(_PREAMBLE)))
+        if not magic == MAGIC:
+            raise(ValueError("not a binary ray file - {}".format(path)))
+        shape = tuple(np.frombuffer(infile.read(8 * ndim), dtype="<i8"))
+        infile.seek(-8, os.SEEK_END)
+        npoints, = struct.unpack("<q", infile.read(8))
+        start = infile.tell() - 8 - 16 * int(np.prod(shape))
+        infile.seek(start)
+        index = np.frombuffer(infile.read(16 * int(np.prod(shape))),
+                              dtype="<i8")
+    offset = struct.calcsize(_PREAMBLE) + 8 * ndim
+    if npoints:
+        points = np.memmap(path, dtype="<f4", mode="r", offset=offset,
+                           shape=(npoints, 3))
+    else:
+        points = np.empty((0, 3), dtype=np.float32)
+    nrays = len(index) // 2
+    return(RaySet(points,
+                  index[:nrays].reshape(shape),
+                  index[nrays:].reshape(shape)))
+
+
+class Coverage(object):
+    """
+    Ray coverage of the nodes of a velocity model, accumulated over
+    any number of rays.
+
+    For every node, **hits** counts the rays passing through the cell
+    around it, **length** sums the length (km) of ray inside that cell
+    and **dws** sums the derivative weight, i.e. the ray length
+    distributed over the surrounding nodes with trilinear weights.
+    Each has the shape of the model's velocity arrays. Rays are
+    resampled to segments no longer than **step** km before binning,
+    and parts of rays outside the model are ignored.
+
+    :param VelocityModel vmodel: velocity model defining the nodes
+    :param float step: maximum segment length (km); defaults to half
+                       the smallest node spacing
+    """
+    def __init__(self, vmodel, step=None):
+        nodes = np.asarray(vmodel._nodes)
+        self.axes = (nodes[:, 0, 0, 0], nodes[0, :, 0, 1], nodes[0, 0, :, 2])
+        self.shape = tuple(len(axis) for axis in self.axes)
+        if step is None:
+            r = self.axes[0]
+            sint = np.sin(self.axes[1]).min()
+            spacing = [np.min(np.diff(axis)) * scale
+                       for axis, scale in zip(self.axes, (1, r[0], r[0] * sint))
+                       if len(axis) > 1]
+            step = 0.5 * min(spacing)
+        self.step = step
+        size = int(np.prod(self.shape))
+        self._hits = np.zeros(size, dtype=np.int64)
+        self._length = np.zeros(size)
+        self._dws = np.zeros(size)
+
+    @property
+    def hits(self):
+        return(self._hits.reshape(self.shape))
+
+    @property
+    def length(self):
+        return(self._length.reshape(self.shape))
+
+    @property
+    def dws(self):
+        return(self._dws.reshape(self.shape))
+
+    def add(self, rays, chunk_size=10000):
+        """
+        Accumulate coverage of **rays**, **chunk_size** rays at a
+        time.
+
+        :param RaySet rays: rays
+        :param int chunk_size: number of rays per chunk
+        """
+        offset, length = rays.offset.ravel(), rays.length.ravel()
+        keep = length > 1
+        offset, length = offset[keep], length[keep]
+        for start in range(0, len(offset), chunk_size):
+            self._add(rays.points,
+                      offset[start:start+chunk_size],
+                      length[start:start+chunk_size])
+        return(self)
+
+    def _add(self, points, offset, length):
+        nseg = length - 1
+        ray = np.repeat(np.arange(len(offset)), nseg)
+        first = np.repeat(offset, nseg)\
+              + np.arange(nseg.sum())\
+              - np.repeat(np.cumsum(nseg) - nseg, nseg)
+        p0 = np.asarray(points[first], dtype=np.float64)
+        p1 = np.asarray(points[first + 1], dtype=np.float64)
+        x0 = _to_cartesian(p0[:, 0], np.pi / 2 - p0[:, 1], p0[:, 2])
+        x1 = _to_cartesian(p1[:, 0], np.pi / 2 - p1[:, 1], p1[:, 2])
+        # Split segments into equal pieces no longer than step and
+        # bin each piece at its midpoint.
+        ds = np.linalg.norm(x1 - x0, axis=-1)
+        nsub = np.maximum(np.ceil(ds / self.step), 1).astype(np.int64)
+        seg = np.repeat(np.arange(len(ds)), nsub)
+        u = (np.arange(nsub.sum())
+             - np.repeat(np.cumsum(nsub) - nsub, nsub) + 0.5) / nsub[seg]
+        x = x0[seg] + u[:, None] * (x1[seg] - x0[seg])
+        ds = (ds / nsub)[seg]
+        ray = ray[seg]
+
+        index, weight, inside = [], [], True
+        for axis, coord in zip(self.axes, _to_spherical(x)):
+            inside = inside & (coord >= axis[0]) & (coord <= axis[-1])
+            if len(axis) == 1:
+                i0 = np.zeros(coord.shape, dtype=np.intp)
+                index.append((i0, i0))
+                weight.append(np.zeros(coord.shape))
+                continue
+            i0 = np.clip(np.searchsorted(axis, coord, side="right") - 1,
+                         0,
+                         len(axis) - 2)
+            index.append((i0, i0 + 1))
+            weight.append(np.clip((coord - axis[i0])
+                                  / (axis[i0 + 1] - axis[i0]), 0, 1))
+        index = [(i0[inside], i1[inside]) for i0, i1 in index]
+        weight = [w[inside] for w in weight]
+        ds, ray = ds[inside], ray[inside]
+        size = len(self._dws)
+
+        def flat(ir, it, ip):
+            return((ir * self.shape[1] + it) * self.shape[2] + ip)
+
+        nearest = flat(*[np.where(w < 0.5, i0, i1)
+                         for (i0, i1), w in zip(index, weight)])
+        self._length += np.bincount(nearest, weights=ds, minlength=size)
+        pairs = np.unique(ray * size + nearest)
+        self._hits += np.bincount(pairs % size, minlength=size)
+        for corner in np.ndindex(2, 2, 2):
+            w = ds.copy()
+            for (i, k) in enumerate(corner):
+                w *= weight[i] if k else 1 - weight[i]
+            node = flat(*[index[i][k] for i, k in enumerate(corner)])
+            self._dws += np.bincount(node, weights=w, minlength=size)
+
+
+def bend(vmodel, sources, receivers, phase="P", spacing=2., tol=1e-6,
+         maxiter=100, enhancement=1., batch_size=10000):
+    """
+    Trace rays between pairs of points by pseudo-bending (Um & Thurber,
+    1987).
+
+    Each ray starts as a straight line with two segments. Every
+    iteration moves all interior points of all unconverged rays
+    together, alternating between odd and even points, towards the
+    local curvature predicted by the velocity and its gradient at the
+    segment midpoint. A ray has converged when its travel time changes
+    by less than **tol** relative to its value. Converged rays are
+    bisected and relaxed again until segments are no longer than
+    **spacing** km, which converges much faster than perturbing a
+    finely sampled straight ray.
+
+    :param VelocityModel vmodel: velocity model
+    :param array-like sources: geographic coordinates (lat, lon,
+                               depth) of ray start points with shape
+                               (npairs, 3)
+    :param array-like receivers: geographic coordinates of ray end
+                                 points with shape (npairs, 3)
+    :param str phase: phase
+    :param float spacing: maximum initial point spacing (km)
+    :param float tol: relative travel-time convergence tolerance
+    :param int maxiter: maximum number of iterations
+    :param float enhancement: over-relaxation factor, between 1 and 2
+    :param int batch_size: number of rays perturbed together
+    :returns: rays indexed by pair, travel times and number of
+              iterations used by each ray
+    :rtype: (RaySet, numpy.ndarray, numpy.ndarray)
+    """
+    def field(x):
+        r, theta, phi = _to_spherical(x)
+        v, dv = vmodel.get_velocity(phase, r, theta, phi, gradient=True)
+        return(v, _spherical_gradient(dv, r, theta, phi))
+    xa = _geo2cart(sources)
+    xb = _geo2cart(receivers)
+    points, length, tts, niter = _bend(field, xa, xb, spacing, tol,
+                                       maxiter, enhancement, batch_size)
+    r, theta, phi = _to_spherical(points)
+    points = np.stack([r, np.pi / 2 - theta, phi], axis=-1)
+    return(RaySet(points, np.cumsum(length) - length, length), tts, niter)
+
+
+def _bend(field, xa, xb, spacing, tol, maxiter, enhancement, batch_size):
+    """
+    Pseudo-bending in Cartesian coordinates. **field** returns
+    velocity and its Cartesian gradient at points with shape (..., 3).
+    """
+    xa, xb = np.atleast_2d(xa), np.atleast_2d(xb)
+    npairs = len(xa)
+    # Rays are refined by repeated bisection, so every ray has a power
+    # of two segments.
+    nseg = np.ceil(np.linalg.norm(xb - xa, axis=-1) / spacing)
+    nseg = 2**np.ceil(np.log2(np.maximum(nseg, 2))).astype(np.int64)
+    length = nseg + 1
+    offset = np.cumsum(length) - length
+    points = np.empty((length.sum(), 3))
+    tts = np.empty(npairs)
+    niter = np.zeros(npairs, dtype=np.int64)
+    for npts in np.unique(length):
+        group = np.flatnonzero(length == npts)
+        for start in range(0, len(group), batch_size):
+            batch = group[start:start+batch_size]
+            X = np.stack([xa[batch],
+                          0.5 * (xa[batch] + xb[batch]),
+                          xb[batch]], axis=1)
+            while True:
+                tt, it = _relax(field, X, tol, maxiter, enhancement)
+                niter[batch] += it
+                if X.shape[1] == npts:
+                    break
+                X = _bisect(X)
+            points[offset[batch, None] + np.arange(npts)] = X
+            tts[batch] = tt
+    return(points, length, tts, niter)
+
+
+def _bisect(X):
+    """
+    Insert the midpoint of every segment of rays **X**.
+    """
+    nrays, npts, _ = X.shape
+    Y = np.empty((nrays, 2 * npts - 1, 3))
+    Y[:, ::2] = X
+    Y[:, 1::2] = 0.5 * (X[:, :-1] + X[:, 1:])
+    return(Y)
+
+
+def _relax(field, X, tol, maxiter, enhancement):
+    """
+    Iterate pseudo-bending perturbations of rays **X** with shape
+    (nrays, npts, 3) in place until convergence.
+    """
+    nrays, npts, _ = X.shape
+    tt = _traveltime(field, X)
+    niter = np.zeros(nrays, dtype=np.int64)
+    active = np.arange(nrays)
+    for iteration in range(maxiter):
+        if len(active) == 0 or npts < 3:
+            break
+        Xa = X[active]
+        for first in (1, 2):
+            k = np.arange(first, npts - 1, 2)
+            if len(k) == 0:
+                continue
+            x0, x1 = Xa[:, k - 1], Xa[:, k + 1]
+            v0, _ = field(x0)
+            v1, _ = field(x1)
+            xm = 0.5 * (x0 + x1)
+            vm, gm = field(xm)
+            d = x1 - x0
+            L = 0.5 * np.linalg.norm(d, axis=-1)
+            t = d / (2 * L[..., None])
+            n = gm - np.sum(gm * t, axis=-1)[..., None] * t
+            nn = np.linalg.norm(n, axis=-1)
+            c = 0.5 * (1 / v0 + 1 / v1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                nhat = np.where(nn[..., None] > 0, n / nn[..., None], 0.)
+                q = (c * vm + 1) / (4 * c * nn)
+                a = L**2 / (2 * c * vm)
+                # Stable form of -q + sqrt(q**2 + a).
+                Rc = np.where(nn > 0, a / (q + np.sqrt(q**2 + a)), 0.)
+            xnew = xm + Rc[..., None] * nhat
+            Xa[:, k] += enhancement * (xnew - Xa[:, k])
+        X[active] = Xa
+        tt_new = _traveltime(field, Xa)
+        niter[active] += 1
+        done = np.abs(tt_new - tt[active]) <= tol * tt_new
+        tt[active] = tt_new
+        active = active[~done]
+    return(tt, niter)
+
+
+def _traveltime(field, X):
+    v, _ = field(X)
+    ds = np.linalg.norm(np.diff(X, axis=1), axis=-1)
+    return(np.sum(ds * 0.5 * (1 / v[:, :-1] + 1 / v[:, 1:]), axis=-1))
+
+
+def _geo2cart(coords):
+    coords = np.atleast_2d(np.asarray(coords, dtype=np.float64))
+    return(_to_cartesian(_constants.EARTH_RADIUS - coords[:, 2],
+                         np.radians(90. - coords[:, 0]),
+                         np.radians(coords[:, 1])))
+
+
+def _to_cartesian(r, theta, phi):
+    return(np.stack([r * np.sin(theta) * np.cos(phi),
+                     r * np.sin(theta) * np.sin(phi),
+                     r * np.cos(theta)], axis=-1))
+
+
+def _to_spherical(x):
+    r = np.linalg.norm(x, axis=-1)
+    return(r, np.arccos(x[..., 2] / r), np.arctan2(x[..., 1], x[..., 0]))
+
+
+def _spherical_gradient(dv, r, theta, phi):
+    """
+    Convert partial derivatives with respect to (r, theta, phi) into a
+    Cartesian gradient.
+    """
+    st, ct, sp, cp = np.sin(theta), np.cos(theta), np.sin(phi), np.cos(phi)
+    gr = dv[..., 0]
+    gt = dv[..., 1] / r
+    gp = dv[..., 2] / (r * st)
+    return(np.stack([gr * st * cp + gt * ct * cp - gp * sp,
+                     gr * st * sp + gt * ct * sp + gp * cp,
+                     gr * ct - gt * st], axis=-1))
+
+
+def _linear_field(v0, gradient, x0):
+    """
+    Return a velocity field v0 + gradient . (x - x0) in Cartesian
+    coordinates.
+    """
+    gradient = np.asarray(gradient, dtype=np.float64)
+    def field(x):
+        v = v0 + np.sum((x - x0) * gradient, axis=-1)
+        return(v, np.broadcast_to(gradient, x.shape))
+    return(field)
+
+
+def _test_pairs(npairs, seed=0):
+    rng = np.random.default_rng(seed)
+    sources = np.stack([rng.uniform(33., 34., npairs),
+                        rng.uniform(-117., -116., npairs),
+                        rng.uniform(0., 20., npairs)], axis=-1)
+    receivers = np.stack([rng.uniform(33., 34., npairs),
+                          rng.uniform(-117., -116., npairs),
+                          np.zeros(npairs)], axis=-1)
+    return(_geo2cart(sources), _geo2cart(receivers))
+
+
+def accuracy(npairs=1000, v0=6., gradient=0.05, spacing=2.):
+    """
+    Compare bent-ray travel times against analytic travel times in a
+    homogeneous model and in a model whose velocity increases
+    linearly with depth, v = v0 + g z, for which the travel time is
+    arccosh(1 + g^2 |x1 - x0|^2 / (2 v(x0) v(x1))) / g.
+
+    :returns: maximum relative travel-time errors for the homogeneous
+              and gradient models
+    :rtype: dict
+    """
+    xa, xb = _test_pairs(npairs)
+    x0 = _geo2cart([33.5, -116.5, 0.])[0]
+    up = x0 / np.linalg.norm(x0)
+    results = {}
+    for model, g in (("homogeneous", 0.), ("gradient", gradient)):
+        field = _linear_field(v0, -g * up, x0)
+        _, _, tts, _ = _bend(field, xa, xb, spacing, 1e-8, 200, 1., 10000)
+        va, vb = field(xa)[0], field(xb)[0]
+        dist = np.linalg.norm(xb - xa, axis=-1)
+        if g == 0:
+            analytic = dist / v0
+        else:
+            analytic = np.arccosh(1 + g**2 * dist**2 / (2 * va * vb)) / g
+        results[model] = np.max(np.abs(tts - analytic) / analytic)
+    return(results)
+
+
+def benchmark(npairs=100000, v0=6., gradient=0.05, spacing=2.):
+    """
+    Time tracing **npairs** rays through a linear-gradient model.
+
+    :returns: elapsed time (s) and rays traced per second
+    :rtype: (float, float)
+    """
+    xa, xb = _test_pairs(npairs)
+    x0 = _geo2cart([33.5, -116.5, 0.])[0]
+    field = _linear_field(v0, -gradient * x0 / np.linalg.norm(x0), x0)
+    start = time.perf_counter()
+    _bend(field, xa, xb, spacing, 1e-6, 100, 1., 10000)
+    elapsed = time.perf_counter() - start
+    return(elapsed, npairs / elapsed)
+
+
+if __name__ == "__main__":
+    for model, error in accuracy().items():
+        print("{:12s} max relative error {:.2e}".format(model, error))
+    elapsed, rate = benchmark()
+    print("traced in {:.2f} s ({:.0f} rays/s)".format(elapsed, rate))
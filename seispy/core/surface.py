@@ -11,25 +11,12 @@ class GeoSurface(object):
         pass
 
     def _callable(self, lat, lon):
-# HACK
-# THIS NEEDS TO BE CLEANED UP
-        #lon = lon % 360 - 360
-        _, theta, phi = seispy.coords.as_geographic([lat, lon, 0]).to_spherical()
-        itheta = (theta - self.grid.theta0) / self.grid.dtheta
-        itheta0 = int(min([max([0, np.floor(itheta)]), self.grid.ntheta - 1]))
-        itheta1 = int(max([0, min([self.grid.ntheta-1, np.ceil(itheta)])]))
-        iphi = (phi - self.grid.phi0) / self.grid.dphi
-        iphi0 = int(min([max([0, np.floor(iphi)]), self.grid.nphi - 1]))
-        iphi1 = int(max([0, min([self.grid.nphi, np.ceil(iphi)])]))
-        R00 = self.coordinates[itheta0, iphi0, 0]
-        R01 = self.coordinates[itheta0, iphi1, 0]
-        R10 = self.coordinates[itheta1, iphi0, 0]
-        R11 = self.coordinates[itheta1, iphi1, 0]
-        dtheta = theta - self.coordinates[itheta0, iphi0, 1]
-        dphi = phi - self.coordinates[itheta0, iphi0, 2]
-        R0 = R00 + (R10 - R00) * dtheta
-        R1 = R01 + (R11 - R01) * dtheta
-        return(R0 + (R1 - R0) * dphi)
+        theta = np.radians(90. - np.asarray(lat, dtype=np.float64))
+        phi = np.radians(np.asarray(lon, dtype=np.float64))
+        return(bilinear(self.coordinates[..., 0],
+                        self.grid.theta0, self.grid.dtheta,
+                        self.grid.phi0, self.grid.dphi,
+                        theta, phi))
 
     def read(self, infile):
         infile = open(infile)
@@ -58,8 +45,51 @@ class GeoSurface(object):
 
 
     def __call__(self, lat, lon):
+        """
+        Return the radius of the surface at geographic coordinates.
+
+        :param array-like lat: latitudes
+        :param array-like lon: longitudes
+        :returns: radii with the broadcast shape of **lat** and
+                  **lon**
+        :rtype: float or numpy.ndarray
+        """
         return(self._callable(lat, lon))
 
+
+def bilinear(values, theta0, dtheta, phi0, dphi, theta, phi):
+    """
+    Interpolate **values** given on a regular (theta, phi) grid at many
+    points at once. Points outside the grid take the value at its
+    edge.
+
+    :param numpy.ndarray values: values with shape (ntheta, nphi),
+                                 theta increasing along the first axis
+    :param float theta0: theta of the first row
+    :param float dtheta: theta spacing
+    :param float phi0: phi of the first column
+    :param float dphi: phi spacing
+    :param array-like theta: polar coordinates of query points
+    :param array-like phi: azimuthal coordinates of query points
+    :returns: interpolated values with the broadcast shape of
+              **theta** and **phi**
+    :rtype: float or numpy.ndarray
+    """
+    theta, phi = np.broadcast_arrays(theta, phi)
+    index, weight = [], []
+    for x0, dx, n, x in ((theta0, dtheta, values.shape[0], theta),
+                         (phi0, dphi, values.shape[1], phi)):
+        x = (x - x0) / dx if n > 1 else np.zeros(x.shape)
+        i0 = np.clip(np.floor(x).astype(np.intp), 0, max(n - 2, 0))
+        index.append((i0, np.minimum(i0 + 1, n - 1)))
+        weight.append(np.clip(x - i0, 0, 1))
+    (it0, it1), (ip0, ip1) = index
+    wt, wp = weight
+    v0 = values[it0, ip0] + (values[it1, ip0] - values[it0, ip0]) * wt
+    v1 = values[it0, ip1] + (values[it1, ip1] - values[it0, ip1]) * wt
+    v = v0 + (v1 - v0) * wp
+    return(v if v.ndim else float(v))
+
 def test():
     geosurf = GeoSurface()
     geosurf.read("/Users/malcolcw/Projects/Shared/Topography/anza.xyz")
@@ -1,5 +1,7 @@
 # coding=utf-8
+import os
 import numpy as np
+import pandas as pd
 import seispy
 
 class Topography(object):
@@ -7,43 +9,73 @@ class Topography(object):
     A queryable container class to interpolate topographic data on a
     regular grid.
     """
-    def __init__(self, infile):
-        infile = open(infile)
-        R, T, P = [], [], []
-        for line in infile:
-            lon, lat, elev = [float(v) for v in line.split()]
-            r, theta, phi = seispy.geometry.geo2sph(lat, lon, -elev / 1000.)
-            R += [r]
-            T += [theta]
-            P += [phi]
-        self.theta = np.array(sorted(list(set(T))))
+    def __init__(self, infile, cache=True):
+        """
+        Load a regular grid of "lon lat elevation" lines, with
+        elevation in meters.
+
+        With **cache**, the parsed grid is saved to a binary sidecar
+        file next to **infile** and reloaded from it while **infile**
+        is unchanged.
+
+        :param str infile: path to xyz topography file
+        :param bool cache: use a binary sidecar cache
+        """
+        sidecar = infile + ".npz"
+        stat = os.stat(infile)
+        stamp = np.array([stat.st_size, stat.st_mtime_ns])
+        if cache and os.path.isfile(sidecar):
+            with np.load(sidecar) as npz:
+                if np.array_equal(npz["stamp"], stamp):
+                    self._initialize(npz["theta"], npz["phi"], npz["radius"])
+                    return
+        lon, lat, elev = pd.read_csv(infile,
+                                     sep=r"\s+",
+                                     header=None,
+                                     usecols=[0, 1, 2],
+                                     dtype=np.float64).values.T
+        theta, itheta = np.unique(np.radians(90. - lat), return_inverse=True)
+        phi, iphi = np.unique(np.radians(lon), return_inverse=True)
+        radius = np.full((len(theta), len(phi)), np.nan)
+        radius[itheta, iphi] = seispy.constants.EARTH_RADIUS + elev / 1000.
+        self._initialize(theta, phi, radius)
+        if cache:
+            try:
+                with seispy.atomic.AtomicFile(sidecar, "wb") as outf:
+                    np.savez(outf, theta=theta, phi=phi, radius=radius,
+                             stamp=stamp)
+            except OSError:
+                # The cache is optional; a read-only directory is fine.
+                pass
+
+    def _initialize(self, theta, phi, radius):
+        self.theta = theta
         self.ntheta = len(self.theta)
         self.theta0 = self.theta[0]
-        self.dtheta = (self.theta[-1] - self.theta0) / self.ntheta
-        self.phi = np.array(sorted(list(set(P))))
+        self.dtheta = (self.theta[-1] - self.theta0) / max(self.ntheta - 1, 1)
+        self.phi = phi
         self.nphi = len(self.phi)
         self.phi0 = self.phi[0]
-        self.dphi = (self.phi[-1] - self.phi0) / self.nphi
-        self.radius = np.empty(shape=(len(set(T)), len(set(P))))
-        for i in range(len(R)):
-            itheta = np.where(self.theta == T[i])
-            iphi = np.where(self.phi == P[i])
-            self.radius[itheta, iphi] = R[i]
+        self.dphi = (self.phi[-1] - self.phi0) / max(self.nphi - 1, 1)
+        self.radius = radius
 
     def __call__(self, lat, lon):
-        r, theta, phi = seispy.geometry.geo2sph((lat, lon, 0))
-        itheta0 = np.argmin(np.absolute(self.theta - theta))
-        iphi0 = np.argmin(np.absolute(self.phi - phi))
-        dtheta, dphi = self.theta[itheta0] % 1., self.phi[iphi0] % 1.
-        itheta1 = min(itheta0 + 1, self.ntheta - 1)
-        iphi1 = min(iphi0 + 1, self.nphi - 1)
-        T00 = self.radius[itheta0, iphi0]
-        T01 = self.radius[itheta0, iphi1]
-        T10 = self.radius[itheta1, iphi0]
-        T11 = self.radius[itheta1, iphi1]
-        T0 = T00 + (T10 - T00) * dtheta
-        T1 = T01 + (T11 - T01) * dtheta
-        return(T0 + (T1 - T0) * dphi)
+        """
+        Return the radius of the topographic surface at geographic
+        coordinates by bilinear interpolation.
+
+        :param array-like lat: latitudes
+        :param array-like lon: longitudes
+        :returns: radii with the broadcast shape of **lat** and
+                  **lon**
+        :rtype: float or numpy.ndarray
+        """
+        theta = np.radians(90. - np.asarray(lat, dtype=np.float64))
+        phi = np.radians(np.asarray(lon, dtype=np.float64))
+        return(seispy.surface.bilinear(self.radius,
+                                       self.theta0, self.dtheta,
+                                       self.phi0, self.dphi,
+                                       theta, phi))
 
 if __name__ == "__main__":
     print("WARNING:: topography.py not an executable script")
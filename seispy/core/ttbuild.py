@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Build station travel-time tables from a velocity model.
+
+.. autofunction:: build_tables
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from . import eikonal as _eikonal
+from . import ttgrid as _ttgrid
+
+CHECKPOINT = ".ttbuild.checkpoint"
+
+
+def build_tables(ttdir, vmodel, site, grid, phases=("P", "S"), ext="",
+                 max_workers=None, mp_context=None, resume=True,
+                 **kwargs):
+    """
+    Compute the travel-time table of every station and phase with the
+    eikonal solver in a pool of worker processes, write them to
+    **ttdir** and write a manifest.
+
+    Completed tables are recorded in a checkpoint file in **ttdir**,
+    so rerunning an interrupted build with the same arguments only
+    computes the missing tables. The checkpoint also records a
+    fingerprint of the grid, phases, solver arguments, station
+    coordinates and sampled velocities; resuming against a different
+    model or site table raises an error. Tables listed in the
+    checkpoint but left incomplete are rebuilt.
+
+    Stations above the top of the grid are placed on its top surface.
+    Stations outside its latitude or longitude range raise an error
+    before any table is built.
+
+    Keyword arguments are passed to :func:`seispy.eikonal.solve`.
+
+    :param str ttdir: output directory
+    :param VelocityModel vmodel: velocity model
+    :param pandas.DataFrame site: css3.0 site table with *sta*,
+                                  *lat*, *lon* and *elev* fields
+    :param GeoGrid3D grid: grid specification
+    :param tuple phases: phases
+    :param str ext: file name extension, e.g. ".tt"
+    :param int max_workers: number of worker processes
+    :param mp_context: multiprocessing context for the pool
+    :param bool resume: resume from an existing checkpoint; if False,
+                        the checkpoint is discarded and every table is
+                        rebuilt
+    :returns: paths of the written files
+    :rtype: list
+    :raises ValueError: if a station lies outside the grid or the
+                        checkpoint does not match
+    """
+    site = site.drop_duplicates("sta", keep="last")
+    lat1 = grid.lat0 + (grid.nlat - 1) * grid.dlat
+    lon1 = grid.lon0 + (grid.nlon - 1) * grid.dlon
+    outside = [sta for sta, lat, lon in zip(site["sta"],
+                                            site["lat"],
+                                            site["lon"])
+               if not (grid.lat0 <= lat <= lat1 and grid.lon0 <= lon <= lon1)]
+    if outside:
+        raise(ValueError("stations outside grid: {}".format(
+            ", ".join(sorted(outside)))))
+    depth0 = grid.depth0
+    depth1 = grid.depth0 + (grid.ndepth - 1) * grid.ddepth
+    coords = {sta: (lat, lon, np.clip(-elev, depth0, depth1))
+              for sta, lat, lon, elev in zip(site["sta"],
+                                             site["lat"],
+                                             site["lon"],
+                                             site["elev"])}
+    velocity = {phase: _eikonal.sample_velocity(vmodel, phase, grid)
+                for phase in phases}
+
+    os.makedirs(ttdir, exist_ok=True)
+    checkpoint = os.path.join(ttdir, CHECKPOINT)
+    fingerprint = _fingerprint(grid, phases, velocity, coords, kwargs)
+    if not resume and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+    if os.path.isfile(checkpoint):
+        with open(checkpoint) as infile:
+            line = infile.readline()
+        if not json.loads(line).get("fingerprint") == fingerprint:
+            raise(ValueError("checkpoint {} was written for a different model "
+                             "or grid; remove it or pass "
+                             "resume=False".format(checkpoint)))
+    else:
+        with open(checkpoint, "w") as outfile:
+            outfile.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+
+    keys = [(sta, phase) for sta in sorted(coords) for phase in phases]
+    # The sampled velocities are sent once to each worker rather than
+    # with every job.
+    return(_ttgrid.write_tables(ttdir,
+                                grid,
+                                _station_table,
+                                keys,
+                                ext=ext,
+                                max_workers=max_workers,
+                                mp_context=mp_context,
+                                checkpoint=checkpoint,
+                                initializer=_initialize_worker,
+                                initargs=(velocity, coords, kwargs)))
+
+
+_WORKER_STATE = None
+
+
+def _initialize_worker(velocity, coords, kwargs):
+    global _WORKER_STATE
+    _WORKER_STATE = velocity, coords, kwargs
+
+
+def _station_table(station, phase, grid):
+    velocity, coords, kwargs = _WORKER_STATE
+    return(_eikonal.solve(velocity[phase], grid, coords[station], **kwargs))
+
+
+def _fingerprint(grid, phases, velocity, coords, kwargs):
+    digest = hashlib.sha256()
+    digest.update(repr((_ttgrid.grid_header(grid),
+                        tuple(phases),
+                        sorted((sta, tuple(float(x) for x in coords[sta]))
+                               for sta in coords),
+                        sorted(kwargs.items()))).encode())
+    for phase in phases:
+        digest.update(np.ascontiguousarray(velocity[phase]).tobytes())
+    return(digest.hexdigest())
@@ -0,0 +1,339 @@
+# coding=utf-8
+"""
+This module provides a block-compressed alternative to the raw
+float32 travel-time file format read by
+:class:`~seispy.core.ttgrid.TTGrid`.
+
+A compressed file starts with the same 36-byte grid definition as a
+raw file, followed by::
+
+    b"TTZ1"                       magic
+    int32                         codec
+    3 * int32                     block shape (nr, ntheta, nphi)
+    int32                         number of blocks
+    (nblocks + 1) * uint64        byte offsets of block payloads
+    block payloads
+
+The grid is cut into bricks of nodes, each compressed independently
+with one of the codecs:
+
+* ``"lossless"`` - float32 bit patterns, delta-coded along r,
+  byte-shuffled and deflated. Exact.
+* ``"int16"`` - offsets from the block minimum quantized in steps of
+  **step** seconds, delta-coded and deflated. Error <= step / 2.
+  Blocks whose range exceeds 65535 steps are stored losslessly.
+* ``"float16"`` - offsets from the block minimum stored as float16
+  and deflated. Relative error <= 2**-11 of the block range.
+
+TTGrid opens compressed files transparently; decompressed blocks are
+kept in an LRU cache so that repeated queries of the same region are
+served from memory.
+"""
+import collections
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from . import atomic as _atomic
+
+MAGIC = b"TTZ1"
+CODECS = ("lossless", "int16", "float16")
+HEADER_SIZE = 36
+_PREAMBLE = "=4si3ii"
+
+
+class BlockCache(object):
+    """
+    A thread-safe LRU cache of decompressed blocks.
+
+    :param int max_blocks: maximum number of cached blocks
+    """
+    def __init__(self, max_blocks=4096):
+        self.max_blocks = max(1, int(max_blocks))
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Return the block cached under **key**, calling **loader** to
+        produce it on a miss.
+        """
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                return(self._blocks[key])
+        # Decompress outside the lock; concurrent misses on the same
+        # block merely duplicate work.
+        block = loader()
+        with self._lock:
+            self._blocks[key] = block
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+        return(block)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+class CompressedTable(object):
+    """
+    Random-access reader for a block-compressed travel-time table.
+    Supports integer (fancy) indexing by flat node index, like the
+    flat view of a raw table, and conversion to a full array with
+    :func:`numpy.asarray`.
+
+    A table has no close method: like an array view of a raw map, it
+    keeps the map alive for as long as any reader holds it, and the
+    map is released when the table is garbage collected.
+
+    :param mmap.mmap mmf: memory map of the file
+    :param tuple shape: grid shape (nr, ntheta, nphi)
+    :param BlockCache cache: cache for decompressed blocks
+    :param key: cache key identifying this table
+    """
+    def __init__(self, mmf, shape, cache=None, key=None):
+        # Holding a view keeps the map alive while the table is in use.
+        self._buffer = np.frombuffer(mmf, dtype=np.uint8)
+        self._mmf = mmf
+        self.shape = tuple(shape)
+        self.cache = BlockCache() if cache is None else cache
+        self.key = id(self) if key is None else key
+        offset = HEADER_SIZE + struct.calcsize(_PREAMBLE)
+        magic, codec, br, bt, bp, nblocks = struct.unpack(
+            _PREAMBLE, self._buffer[HEADER_SIZE:offset].tobytes()
+        )
+        if not magic == MAGIC:
+            raise(ValueError("not a compressed travel-time file"))
+        self.codec = CODECS[codec]
+        self.block_shape = (br, bt, bp)
+        self.nblocks = [-(-n // b) for n, b in zip(self.shape,
+                                                   self.block_shape)]
+        self.offsets = np.frombuffer(self._buffer,
+                                     dtype=np.uint64,
+                                     count=nblocks + 1,
+                                     offset=offset).astype(np.int64)
+
+    @property
+    def size(self):
+        return(self.shape[0] * self.shape[1] * self.shape[2])
+
+    def __len__(self):
+        return(self.size)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[np.arange(self.size)]
+        return(data if dtype is None else data.astype(dtype))
+
+    def __getitem__(self, index):
+        index = np.asarray(index)
+        flat = index.ravel()
+        nr, ntheta, _ = self.shape
+        br, bt, bp = self.block_shape
+        nbr, nbt, _ = self.nblocks
+        ir, itheta, iphi = flat % nr, (flat // nr) % ntheta, flat // (nr * ntheta)
+        block = ir // br + nbr * (itheta // bt + nbt * (iphi // bp))
+        out = np.empty(flat.shape, dtype=np.float32)
+        ublock, inverse = np.unique(block, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(ublock) + 1))
+        for iblock, ib in enumerate(ublock):
+            select = order[bounds[iblock]:bounds[iblock+1]]
+            data, extent = self._get_block(ib)
+            local = (ir[select] % br)\
+                + extent[0] * ((itheta[select] % bt)
+                               + extent[1] * (iphi[select] % bp))
+            out[select] = data[local]
+        return(out.reshape(index.shape))
+
+    def _get_block(self, ib):
+        return(self.cache.get((self.key, int(ib)),
+                              lambda: self._decode_block(int(ib))))
+
+    def _block_extent(self, ib):
+        nbr, nbt, _ = self.nblocks
+        ibr, ibt, ibp = ib % nbr, (ib // nbr) % nbt, ib // (nbr * nbt)
+        return(tuple(min(b, n - i * b)
+                     for i, b, n in zip((ibr, ibt, ibp),
+                                        self.block_shape,
+                                        self.shape)))
+
+    def _decode_block(self, ib):
+        extent = self._block_extent(ib)
+        payload = self._buffer[self.offsets[ib]:self.offsets[ib+1]].tobytes()
+        return(_decode(self.codec, payload, np.prod(extent)), extent)
+
+
+def _shuffle(data):
+    return(data.view(np.uint8).reshape(-1, data.itemsize).T.tobytes())
+
+
+def _unshuffle(raw, dtype, count):
+    itemsize = np.dtype(dtype).itemsize
+    return(np.frombuffer(raw, dtype=np.uint8
+                         ).reshape(itemsize, count).T.copy().view(dtype).ravel())
+
+
+def _encode(codec, data, step, level):
+    """
+    Compress a flat float32 block.
+    """
+    if codec == "lossless":
+        bits = data.view(np.uint32)
+        delta = np.diff(bits, prepend=np.uint32(0))
+        return(zlib.compress(_shuffle(delta), level))
+    if not np.all(np.isfinite(data)):
+        raise(ValueError(f"codec {codec} requires finite travel times"))
+    offset = np.float64(data.min())
+    if codec == "int16":
+        if not step > 0:
+            raise(ValueError("quantization step must be positive"))
+        if (np.float64(data.max()) - offset) / step > 65535:
+            # The block range does not fit in 16 bits at the requested
+            # step; store it losslessly rather than loosen the bound. A
+            # zero step marks such blocks.
+            return(struct.pack("=2d", offset, 0.)
+                   + _encode("lossless", data, step, level))
+        bstep = np.float64(step)
+        quant = np.rint((data - offset) / bstep).astype(np.uint16)
+        delta = np.diff(quant, prepend=np.uint16(0))
+        return(struct.pack("=2d", offset, bstep)
+               + zlib.compress(_shuffle(delta), level))
+    if codec == "float16":
+        half = (data - offset).astype(np.float16)
+        return(struct.pack("=d", offset) + zlib.compress(_shuffle(half), level))
+    raise(ValueError(f"Unrecognized codec - {codec}"))
+
+
+def _decode(codec, payload, count):
+    """
+    Decompress a block to flat float32 values.
+    """
+    if codec == "lossless":
+        delta = _unshuffle(zlib.decompress(payload), np.uint32, count)
+        return(np.cumsum(delta, dtype=np.uint32).view(np.float32))
+    if codec == "int16":
+        offset, bstep = struct.unpack("=2d", payload[:16])
+        if bstep == 0:
+            return(_decode("lossless", payload[16:], count))
+        delta = _unshuffle(zlib.decompress(payload[16:]), np.uint16, count)
+        quant = np.cumsum(delta, dtype=np.uint16)
+        return((offset + quant * bstep).astype(np.float32))
+    offset, = struct.unpack("=d", payload[:8])
+    half = _unshuffle(zlib.decompress(payload[8:]), np.float16, count)
+    return((offset + half.astype(np.float64)).astype(np.float32))
+
+
+def compress(header, data, outfile, codec="int16", step=1e-3,
+             block_shape=(16, 16, 16), level=6):
+    """
+    Write a travel-time table in the block-compressed format.
+
+    :param tuple header: grid definition (nr, nlat, nlon, dr, dlat,
+                         dlon, r0, lat0, lon0)
+    :param array-like data: travel times with shape (nr, ntheta, nphi)
+    :param str outfile: output path
+    :param str codec: compression codec - ("lossless", "int16",
+                      "float16")
+    :param float step: quantization step of the "int16" codec; blocks
+                       spanning more than 65535 steps are stored
+                       losslessly {**Units**: s}
+    :param tuple block_shape: number of nodes per block along (r,
+                              theta, phi)
+    :param int level: zlib compression level
+    """
+    if codec not in CODECS:
+        raise(ValueError(f"Unrecognized codec - {codec}"))
+    data = np.asarray(data, dtype=np.float32)
+    shape = tuple(header[:3])
+    if not data.shape == shape:
+        raise(ValueError("travel-time array does not match header"))
+    br, bt, bp = block_shape
+    nbr, nbt, nbp = [-(-n // b) for n, b in zip(shape, block_shape)]
+    payloads = []
+    for ibp in range(nbp):
+        for ibt in range(nbt):
+            for ibr in range(nbr):
+                block = data[ibr*br:(ibr+1)*br,
+                             ibt*bt:(ibt+1)*bt,
+                             ibp*bp:(ibp+1)*bp]
+                # Flatten with r varying fastest, as in raw files.
+                payloads.append(_encode(codec,
+                                        np.ascontiguousarray(block.T).ravel(),
+                                        step,
+                                        level))
+    nblocks = len(payloads)
+    start = HEADER_SIZE + struct.calcsize(_PREAMBLE) + 8 * (nblocks + 1)
+    offsets = start + np.cumsum([0] + [len(p) for p in payloads],
+                                dtype=np.uint64)
+    with _atomic.AtomicFile(outfile, "wb") as outf:
+        outf.write(struct.pack("3i3f3f", *header))
+        outf.write(struct.pack(_PREAMBLE, MAGIC, CODECS.index(codec),
+                               br, bt, bp, nblocks))
+        outf.write(offsets.astype(np.uint64).tobytes())
+        for payload in payloads:
+            outf.write(payload)
+
+
+def compress_directory(ttdir, outdir, **kwargs):
+    """
+    Compress every table of the travel-time directory **ttdir** into
+    **outdir**, keeping file names. Keyword arguments are passed to
+    :func:`compress`.
+
+    :returns: total size of raw and compressed files in bytes
+    :rtype: (int, int)
+    """
+    from . import ttgrid as _ttgrid
+    os.makedirs(outdir, exist_ok=True)
+    ttg = _ttgrid.TTGrid(ttdir)
+    nraw, ncompressed = 0, 0
+    for station, phase in ttg.keys:
+        path = ttg.paths[station][phase]
+        outfile = os.path.join(outdir, os.path.basename(path))
+        compress(ttg.header, ttg.get_tt_array(station, phase), outfile,
+                 **kwargs)
+        nraw += os.path.getsize(path)
+        ncompressed += os.path.getsize(outfile)
+    ttg.close()
+    return(nraw, ncompressed)
+
+
+def benchmark(rawdir, compressed_dir, npts=100000, seed=0):
+    """
+    Compare travel times and query throughput of a compressed
+    travel-time directory against the raw memory-mapped tables.
+
+    :param str rawdir: directory of raw tables
+    :param str compressed_dir: directory of the same tables compressed
+    :param int npts: number of random query points
+    :returns: maximum and RMS absolute error {**Units**: s}, and
+              throughput of the raw and compressed paths {**Units**:
+              point-tables/s}
+    :rtype: dict
+    """
+    from . import ttgrid as _ttgrid
+    raw = _ttgrid.TTGrid(rawdir)
+    packed = _ttgrid.TTGrid(compressed_dir)
+    rng = np.random.default_rng(seed)
+    r = raw.r0 + rng.uniform(0, raw.nr - 1, npts) * raw.dr
+    theta = raw.theta0 - rng.uniform(0, raw.ntheta - 1, npts) * raw.dtheta
+    phi = raw.phi0 + rng.uniform(0, raw.nphi - 1, npts) * raw.dphi
+    results = {}
+    for name, ttg in (("raw", raw), ("compressed", packed)):
+        start = time.perf_counter()
+        results[name] = ttg.get_tt_matrix(r, theta, phi)
+        elapsed = time.perf_counter() - start
+        results[name + "_rate"] = results[name].size / elapsed
+    error = np.abs(results["compressed"] - results["raw"])
+    stats = {"max_error": np.nanmax(error),
+             "rms_error": np.sqrt(np.nanmean(np.square(error))),
+             "raw_rate": results["raw_rate"],
+             "compressed_rate": results["compressed_rate"]}
+    raw.close()
+    packed.close()
+    return(stats)
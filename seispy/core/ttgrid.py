@@ -4,71 +4,226 @@ Created on Mon Dec  5 12:53:59 2016
 
 @author: malcolcw
 """
+import collections
+import concurrent.futures
+import functools
+import json
 import numpy as np
+import scipy.sparse
 from math import radians, sin
 import mmap
 import os
 import struct
+import threading
+import zlib
+
+from . import atomic as _atomic
+from . import ttcompress as _ttcompress
+
+MANIFEST = "ttgrid.manifest.json"
 
 
 class TTGrid:
     """
     This class provides query functionality for memory-mapped
     travel-time files.
+
+    Files are opened and memory-mapped lazily on first access. At most
+    **max_open** maps are kept open at once; the least recently used
+    map is closed when the limit is exceeded. Use :meth:`close`, or
+    the instance as a context manager, to release all open maps.
+
+    Query methods are thread-safe: travel times are read through
+    index-based array views rather than the file position of a shared
+    map, and opening and evicting maps is serialized by a lock, so a
+    single instance can be shared by a pool of threads. A map is never
+    unmapped while a view of it is in use.
+
+    Instances pickle to a lightweight descriptor (directory, header
+    and station list) and can be sent to worker processes; see
+    :func:`parallel_map`.
+
+    Tables may be raw float32 files or block-compressed files written
+    by :func:`seispy.core.ttcompress.compress`; the format is detected
+    per file. Decompressed blocks are shared in an LRU cache of at
+    most **max_blocks** blocks.
+
+    If **ttdir** contains a manifest written by :func:`write_manifest`,
+    the grid header and station/phase file mapping are read from it
+    and trusted; otherwise the directory is scanned and the header of
+    one file is read. Headers and sizes of individual files are still
+    checked when they are first opened.
+
+    :param str ttdir: directory containing travel-time files named
+                      *station.phase[.ext]*
+    :param int max_open: maximum number of simultaneously open maps
+    :param int max_blocks: maximum number of cached decompressed
+                           blocks of compressed tables
+    :param bool manifest: use the manifest if one exists
+    :param bool verify: check every file against the manifest (size,
+                        header and checksum) at construction
     """
-    def __init__(self, ttdir):
-        self._initialize_mmap(ttdir)
-        self.byteoffset = np.ndarray(shape=self.nodes['r'].shape)
-        # jump over grid definition
-        offset = 36
-        for iphi in range(self.nphi):
-            for itheta in range(self.ntheta):
-                for ir in range(self.nr):
-                    self.byteoffset[ir, itheta, iphi] = offset
-                    offset += 4
+    def __init__(self, ttdir, max_open=256, max_blocks=4096, manifest=True,
+                 verify=False):
+        self.ttdir = os.path.abspath(ttdir)
+        self.max_open = max(1, int(max_open))
+        self.max_blocks = max_blocks
+        self._initialize_cache()
+        self.manifest = None
+        if manifest and os.path.isfile(os.path.join(self.ttdir, MANIFEST)):
+            self._initialize_manifest()
+        else:
+            self._initialize_mmap(ttdir)
+        self.keys = sorted((station, phase)
+                           for station in self.paths
+                           for phase in self.paths[station])
+        if verify:
+            self.verify()
+
+    def __getstate__(self):
+        """
+        Reduce the instance to a lightweight descriptor. Open maps and
+        locks are not pickled; unpickled instances reopen files lazily
+        and share the OS page cache with every other process mapping
+        the same files.
+        """
+        return {"ttdir": self.ttdir,
+                "max_open": self.max_open,
+                "max_blocks": self.max_blocks,
+                "header": self.header,
+                "paths": self.paths,
+                "keys": self.keys}
+
+    def __setstate__(self, state):
+        self.ttdir = state["ttdir"]
+        self.max_open = state["max_open"]
+        self.max_blocks = state["max_blocks"]
+        self.paths = state["paths"]
+        self.keys = state["keys"]
+        self.manifest = None
+        self._initialize_cache()
+        self._initialize_grid(state["header"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _initialize_cache(self):
+        self._open = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._blocks = _ttcompress.BlockCache(self.max_blocks)
+
+    def _initialize_manifest(self):
+        with open(os.path.join(self.ttdir, MANIFEST)) as infile:
+            self.manifest = json.load(infile)
+        paths = {}
+        for entry in self.manifest["files"]:
+            if entry["station"] not in paths:
+                paths[entry["station"]] = {}
+            paths[entry["station"]][entry["phase"]]\
+                = os.path.join(self.ttdir, entry["file"])
+        self.paths = paths
+        self._initialize_grid(self.manifest["header"])
 
     def _initialize_mmap(self, ttdir):
-        mmttf = {}
-        init = True
-        for infile in os.listdir(ttdir):
-            station, phase = infile.split(".")[:2]
-            infile = open(os.path.abspath(os.path.join(ttdir, infile)), 'rb')
+        paths = _scan(ttdir)
+        self.paths = paths
+        station = sorted(paths)[0]
+        phase = sorted(paths[station])[0]
+        with open(paths[station][phase], "rb") as infile:
+            self._initialize_grid(_read_header(infile))
+
+    def _get_mmap(self, station, phase):
+        """
+        Return the memory map for **station** and **phase**, opening it
+        if necessary, or a :class:`~seispy.core.ttcompress.CompressedTable`
+        for compressed files. The caller must hold :attr:`_lock` for as
+        long as it uses the map without an array view of it.
+        """
+        key = (station, phase)
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key]
+        with open(self.paths[station][phase], "rb") as infile:
+            if not _read_header(infile) == self.header:
+                raise ValueError("travel-time headers do not match")
+            magic = infile.read(len(_ttcompress.MAGIC))
+            # The map holds its own duplicate of the file descriptor.
             mmf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
-            if station not in mmttf:
-                mmttf[station] = {}
-            mmttf[station][phase] = mmf
-            if init:
-                init = False
-                self._initialize_grid(mmf)
-            else:
-                nr, nlat, nlon = struct.unpack("3i", mmf.read(12))
-                dr, dlat, dlon = struct.unpack("3f", mmf.read(12))
-                r0, lat0, lon0 = struct.unpack("3f", mmf.read(12))
-                if not nr == self.nr\
-                        or not nlat == self.nlat\
-                        or not nlon == self.nlon\
-                        or not dr == self.dr\
-                        or not dlat == self.dlat\
-                        or not dlon == self.dlon\
-                        or not r0 == self.r0\
-                        or not lat0 == self.lat0\
-                        or not lon0 == self.lon0:
-                    raise ValueError("travel-time headers do not match")
-        self.mmttf = mmttf
-
-    def _initialize_grid(self, mmf):
-        self.nr, self.nlat, self.nlon\
-            = struct.unpack("3i", mmf.read(12))
-        self.dr, self.dlat, self.dlon\
-            = struct.unpack("3f", mmf.read(12))
-        self.r0, self.lat0, self.lon0\
-            = struct.unpack("3f", mmf.read(12))
+        if magic == _ttcompress.MAGIC and not len(mmf) == self.size:
+            mmf = _ttcompress.CompressedTable(mmf,
+                                              (self.nr,
+                                               self.ntheta,
+                                               self.nphi),
+                                              cache=self._blocks,
+                                              key=key)
+        elif len(mmf) < self.size:
+            mmf.close()
+            raise ValueError("travel-time file is truncated: {:s}".format(
+                self.paths[station][phase]))
+        self._open[key] = mmf
+        while len(self._open) > self.max_open:
+            _close_mmap(self._open.popitem(last=False)[1])
+        return mmf
+
+    def verify(self, checksum=True):
+        """
+        Check every travel-time file against the manifest, or, without
+        a manifest, check file headers and sizes.
+
+        :param bool checksum: also compare file checksums
+        :raises ValueError: listing every file that does not match
+        """
+        entries = _scan_entries(self.ttdir, checksum=checksum)
+        expected = {(entry["station"], entry["phase"]): entry
+                    for entry in self.manifest["files"]}\
+            if self.manifest is not None else None
+        errors = []
+        for entry in entries:
+            key = (entry["station"], entry["phase"])
+            if entry["phase"] not in self.paths.get(entry["station"], {}):
+                continue
+            if not tuple(entry["header"]) == self.header:
+                errors.append("header mismatch: {:s}".format(entry["file"]))
+            elif entry["size"] < self.size and entry["format"] == "raw":
+                errors.append("truncated: {:s}".format(entry["file"]))
+            elif expected is not None and key in expected:
+                if not entry["size"] == expected[key]["size"]:
+                    errors.append("size mismatch: {:s}".format(entry["file"]))
+                elif checksum\
+                        and not entry["crc32"] == expected[key]["crc32"]:
+                    errors.append("checksum mismatch: {:s}".format(
+                        entry["file"]))
+        found = set((entry["station"], entry["phase"]) for entry in entries)
+        errors += ["missing: {:s}.{:s}".format(*key)
+                   for key in self.keys if key not in found]
+        if errors:
+            raise ValueError("travel-time files do not match manifest:\n"
+                             + "\n".join(errors))
+
+    def close(self):
+        """
+        Close all open memory maps. Maps are reopened on demand.
+        """
+        with self._lock:
+            while self._open:
+                _close_mmap(self._open.popitem()[1])
+            self._blocks.clear()
+
+    def _initialize_grid(self, header):
+        self.header = tuple(header)
+        (self.nr, self.nlat, self.nlon,
+         self.dr, self.dlat, self.dlon,
+         self.r0, self.lat0, self.lon0) = header
         self.mr = self.r0 + (self.nr - 1) * self.dr
         self.mlat = self.lat0 + (self.nlat - 1) * self.dlat
         self.mlon = self.lon0 + (self.nlon - 1) * self.dlon
         self.dtheta = radians(self.dlat)
         self.dphi = radians(self.dlon)
         self.ntheta, self.nphi = self.nlat, self.nlon
+        self.size = 36 + 4 * self.nr * self.ntheta * self.nphi
         self.theta0 = radians(90 - self.lat0)
         self.phi0 = radians(self.lon0)
         r = [self.r0 + self.dr * ir for ir in range(self.nr)]
@@ -78,6 +233,10 @@ class TTGrid:
                for ilon in range(self.nlon)]
         R, T, P = np.meshgrid(r, theta, phi, indexing='ij')
         self.nodes = {'r': R, 'theta': T, 'phi': P}
+        # jump over grid definition
+        self.byteoffset = 36 + 4 * np.arange(
+            self.nr * self.ntheta * self.nphi
+        ).reshape(self.nphi, self.ntheta, self.nr).T
 
     def contains(self, r, theta, phi):
         if not self.r0 < r < self.r0 + self.dr * (self.nr - 1):
@@ -88,11 +247,138 @@ class TTGrid:
             return False
         return True
 
+    def get_tt_array(self, station, phase):
+        """
+        Return a read-only (nr, ntheta, nphi) view of the travel-time
+        table for **station** and **phase**. The view is backed by the
+        memory-mapped file; no data are copied. Compressed tables are
+        decompressed into a new array.
+        """
+        return np.asarray(self._get_flat(station, phase)).reshape(
+            self.nphi, self.ntheta, self.nr
+        ).T
+
+    def _get_flat(self, station, phase):
+        # Travel times are stored with r varying fastest, then theta,
+        # then phi, so the flat view is indexed by
+        # ir + nr * (itheta + ntheta * iphi).
+        # The view is created under the lock so that the map cannot be
+        # evicted and closed in between; once created, the view keeps
+        # the map alive. Compressed tables support the same indexing.
+        with self._lock:
+            mmf = self._get_mmap(station, phase)
+            if isinstance(mmf, _ttcompress.CompressedTable):
+                return mmf
+            return np.frombuffer(mmf,
+                                 dtype=np.float32,
+                                 count=self.nr * self.ntheta * self.nphi,
+                                 offset=36)
+
+    def get_stencil(self, r, theta, phi, gradient=False):
+        """
+        Return the flat node indices of the bounding cube and the
+        trilinear interpolation weights for arrays of points.
+
+        Corners are ordered like the output of :meth:`get_tt_cube`.
+        Weights of points outside the grid are NaN.
+
+        :param array-like r: radial coordinates
+        :param array-like theta: polar angles
+        :param array-like phi: azimuthal angles
+        :param bool gradient: also return the derivatives of the
+                              weights with respect to *(r, theta,
+                              phi)* {**Units**: 1/km, 1/radians,
+                              1/radians}, with shape (npts, 8, 3)
+        :returns: flat node indices and interpolation weights, each
+                  with shape (npts, 8)
+        :rtype: (numpy.ndarray, numpy.ndarray)
+        """
+        r, theta, phi = np.broadcast_arrays(*[np.atleast_1d(v).ravel()
+                                              for v in (r, theta, phi)])
+        x = np.stack([(r - self.r0) / self.dr,
+                      (self.theta0 - theta) / self.dtheta,
+                      (phi - self.phi0) / self.dphi])
+        # Derivative of the fractional node index along each axis with
+        # respect to r, theta and phi.
+        dxdq = (1. / self.dr, -1. / self.dtheta, 1. / self.dphi)
+        n = np.array([[self.nr], [self.ntheta], [self.nphi]])
+        inside = np.all((x >= 0) & (x <= n - 1), axis=0)
+        i0 = np.clip(np.floor(x), 0, np.maximum(n - 2, 0)).astype(np.intp)
+        i1 = np.minimum(i0 + 1, n - 1)
+        w1 = np.clip(x - i0, 0., 1.)
+        w0 = 1. - w1
+        index = np.empty((x.shape[1], 8), dtype=np.intp)
+        weight = np.empty((x.shape[1], 8))
+        dweight = np.empty((x.shape[1], 8, 3))
+        for icorner in range(8):
+            b = [(icorner >> iaxis) & 1 for iaxis in range(3)]
+            ir, itheta, iphi = [i1[iaxis] if b[iaxis] else i0[iaxis]
+                                for iaxis in range(3)]
+            index[:, icorner] = ir + self.nr * (itheta + self.ntheta * iphi)
+            w = [w1[iaxis] if b[iaxis] else w0[iaxis] for iaxis in range(3)]
+            weight[:, icorner] = w[0] * w[1] * w[2]
+            if gradient:
+                for iaxis in range(3):
+                    dw = [w[jaxis] if jaxis != iaxis
+                          else (1. if b[iaxis] else -1.) * dxdq[iaxis]
+                          for jaxis in range(3)]
+                    dweight[:, icorner, iaxis] = dw[0] * dw[1] * dw[2]
+        weight[~inside] = np.nan
+        if gradient:
+            dweight[~inside] = np.nan
+            return index, weight, dweight
+        return index, weight
+
+    def stack(self, keys=None):
+        """
+        Return travel-time tables for **keys** stacked into a single
+        in-memory (nkeys, nr, ntheta, nphi) float32 tensor.
+
+        :param list keys: (station, phase) pairs; defaults to
+                          :attr:`keys`
+        """
+        keys = self.keys if keys is None else keys
+        tensor = np.empty((len(keys), self.nphi, self.ntheta, self.nr),
+                          dtype=np.float32)
+        for ikey, (station, phase) in enumerate(keys):
+            tensor[ikey] = self.get_tt_array(station, phase).T
+        return tensor.transpose(0, 3, 2, 1)
+
+    def get_tt_matrix(self, r, theta, phi, keys=None, tensor=None):
+        """
+        Return travel times for every point and station/phase pair.
+
+        A single interpolation stencil is computed for all points and
+        applied either to **tensor** (as returned by :meth:`stack`)
+        or directly to the memory-mapped table of each key.
+
+        :param array-like r: radial coordinates
+        :param array-like theta: polar angles
+        :param array-like phi: azimuthal angles
+        :param list keys: (station, phase) pairs; defaults to
+                          :attr:`keys`. Ignored if **tensor** is given.
+        :param numpy.ndarray tensor: stacked travel-time tensor
+        :returns: travel times with shape (npts, nkeys); NaN for
+                  points outside the grid
+        :rtype: numpy.ndarray
+        """
+        return self.plan(r, theta, phi)(keys=keys, tensor=tensor)
+
+    def plan(self, r, theta, phi, gradient=False):
+        """
+        Return a reusable :class:`QueryPlan` for a fixed set of points.
+
+        :param array-like r: radial coordinates
+        :param array-like theta: polar angles
+        :param array-like phi: azimuthal angles
+        :param bool gradient: also precompute gradient weights
+        :rtype: QueryPlan
+        """
+        return QueryPlan(self, r, theta, phi, gradient=gradient)
+
     def get_node_tt(self, station, phase, ir, itheta, iphi):
-        f = self.mmttf[station][phase]
-        offset = self.byteoffset[ir, itheta, iphi]
-        f.seek(int(offset))
-        return struct.unpack("f", f.read(4))[0]
+        index = ir + self.nr * (itheta + self.ntheta * iphi)
+        return float(self._get_flat(station, phase)[index])
 
     def get_proximal_node(self, r, theta, phi):
         """
@@ -132,38 +418,740 @@ class TTGrid:
         T00 = T000 + (T100 - T000) * delr
         T10 = T010 + (T110 - T010) * delr
         T01 = T001 + (T101 - T001) * delr
-        T11 = T011 + (T111 - T001) * delr
+        T11 = T011 + (T111 - T011) * delr
         T0 = T00 + (T10 - T00) * deltheta
         T1 = T01 + (T11 - T01) * deltheta
         return T0 + (T1 - T0) * delphi
 
     def get_ttgradient(self, station, phase, r, theta, phi):
-        index, delta = self.get_proximal_node(r, theta, phi)
-        ir, itheta, iphi = index
-        (T000, T100, T010, T110,
-         T001, T101, T011, T111) = self.get_tt_cube(station,
-                                                    phase,
-                                                    ir,
-                                                    itheta,
-                                                    iphi)
-        dTdr00 = T100 - T000
-        dTdr10 = T110 - T010
-        dTdr01 = T101 - T001
-        dTdr11 = T111 - T011
-        dTdr = np.mean([dTdr00, dTdr10, dTdr01, dTdr11])
-        dTdt00 = T010 - T000
-        dTdt10 = T110 - T100
-        dTdt01 = T011 - T001
-        dTdt11 = T111 - T101
-        dTdt = np.mean([dTdt00, dTdt10, dTdt01, dTdt11])
-        dTdp00 = T001 - T000
-        dTdp10 = T101 - T100
-        dTdp01 = T011 - T010
-        dTdp11 = T111 - T110
-        dTdp = np.mean([dTdp00, dTdp10, dTdp01, dTdp11])
-        # the discretization of the travel time-field may account for
-        # spherical coordinate transformation...
-        return dTdr, dTdt, dTdp
+        """
+        Return the partial derivatives *(dT/dr, dT/dtheta, dT/dphi)* of
+        the interpolated travel time at a point {**Units**: s/km,
+        s/radian, s/radian}, with theta the colatitude, so dT/dtheta is
+        positive where travel time increases southward.
+
+        .. note::
+           Earlier versions returned travel-time differences between
+           adjacent nodes, averaged over the enclosing cell, in seconds
+           per node step. Their theta component was taken along
+           increasing latitude, i.e. decreasing theta, and so had the
+           opposite sign. To recover the old values, multiply the
+           components by (dr, -dtheta, dphi).
+        """
+        dTdq = self.get_ttgradient_matrix(r, theta, phi,
+                                          keys=[(station, phase)],
+                                          metric=False)
+        return tuple(dTdq[0, 0])
+
+    def get_ttgradient_matrix(self, r, theta, phi, keys=None, metric=True):
+        """
+        Return travel-time gradients for every point and station/phase
+        pair.
+
+        With **metric**, the spherical metric factors are applied and
+        the gradient is returned with respect to displacements in km
+        along the local unit vectors *(dT/dr, dT/(r dtheta),
+        dT/(r sin(theta) dphi))* {**Units**: s/km}. Otherwise the
+        partial derivatives with respect to *(r, theta, phi)* are
+        returned {**Units**: s/km, s/radian, s/radian}.
+
+        :param array-like r: radial coordinates
+        :param array-like theta: polar angles
+        :param array-like phi: azimuthal angles
+        :param list keys: (station, phase) pairs; defaults to
+                          :attr:`keys`
+        :param bool metric: apply spherical metric factors
+        :returns: gradients with shape (npts, nkeys, 3)
+        :rtype: numpy.ndarray
+        """
+        return self.plan(r, theta, phi, gradient=True).gradient(keys=keys,
+                                                                metric=metric)
+
+    def _metric(self, r, theta, phi):
+        """
+        Return the factors converting derivatives with respect to
+        *(r, theta, phi)* to derivatives with respect to displacements
+        in km, with shape (npts, 3).
+        """
+        r, theta, _ = np.broadcast_arrays(*[np.atleast_1d(v).ravel()
+                                            for v in (r, theta, phi)])
+        return np.stack([np.ones(len(r)), 1. / r, 1. / (r * np.sin(theta))],
+                        axis=1)
+
+    def get_jacobian(self, r, theta, phi, event, keys, metric=True,
+                     sparse=True):
+        """
+        Return predicted travel times and the Jacobian of arrival time
+        with respect to the hypocentral parameters of many events.
+
+        Columns are ordered by event, with four parameters per event:
+        *(r, theta, phi, t0)*. With **metric**, the spatial parameters
+        are displacements in km along the local unit vectors (see
+        :meth:`get_ttgradient_matrix`). The matrix is block-sparse and
+        ready for (sparse) least squares, e.g.
+        :func:`scipy.sparse.linalg.lsqr`.
+
+        :param array-like r: radial coordinates of events
+        :param array-like theta: polar angles of events
+        :param array-like phi: azimuthal angles of events
+        :param array-like event: index of the event of each arrival
+        :param list keys: (station, phase) pair of each arrival
+        :param bool metric: apply spherical metric factors
+        :param bool sparse: return a scipy.sparse.csr_matrix instead of
+                            a dense array
+        :returns: travel times with shape (narrivals,) and Jacobian
+                  with shape (narrivals, 4 * nevents)
+        :rtype: (numpy.ndarray, numpy.ndarray or
+                scipy.sparse.csr_matrix)
+        """
+        event = np.asarray(event, dtype=np.intp)
+        index, weight, dweight = self.get_stencil(r, theta, phi,
+                                                  gradient=True)
+        nevents = len(index)
+        if metric:
+            dweight = dweight * self._metric(r, theta, phi)[:, None, :]
+        tt = np.empty(len(event))
+        grad = np.empty((len(event), 3))
+        bykey = collections.defaultdict(list)
+        for iarrival, key in enumerate(keys):
+            bykey[tuple(key)].append(iarrival)
+        for (station, phase), rows in bykey.items():
+            rows = np.asarray(rows)
+            events = event[rows]
+            data = self._get_flat(station, phase)[index[events]]
+            tt[rows] = np.sum(data * weight[events], axis=1)
+            grad[rows] = np.einsum("pc,pcj->pj", data, dweight[events])
+        rows = np.repeat(np.arange(len(event)), 4)
+        cols = (4 * event[:, None] + np.arange(4)).ravel()
+        values = np.concatenate([grad, np.ones((len(event), 1))],
+                                axis=1).ravel()
+        shape = (len(event), 4 * nevents)
+        if sparse:
+            return tt, scipy.sparse.csr_matrix((values, (rows, cols)),
+                                               shape=shape)
+        jacobian = np.zeros(shape)
+        jacobian[rows, cols] = values
+        return tt, jacobian
+
+class QueryPlan(object):
+    """
+    Precomputed interpolation stencil for a fixed array of points.
+
+    The cell indices and trilinear weights are computed once and can
+    then be applied to any station/phase table, or to a whole stacked
+    network tensor with a single gather and multiply. Useful when the
+    same hypocentres are evaluated repeatedly, e.g. in iterative
+    relocation and residual computation.
+
+    :param TTGrid ttgrid: travel-time grid defining the stencil
+    :param array-like r: radial coordinates
+    :param array-like theta: polar angles
+    :param array-like phi: azimuthal angles
+    :param bool gradient: also precompute gradient weights
+    """
+    def __init__(self, ttgrid, r, theta, phi, gradient=False):
+        self.ttgrid = ttgrid
+        self.header = ttgrid.header
+        stencil = ttgrid.get_stencil(r, theta, phi, gradient=gradient)
+        self.index, self.weight = stencil[:2]
+        self.dweight = stencil[2] if gradient else None
+        self.metric = ttgrid._metric(r, theta, phi) if gradient else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def _check(self, ttgrid):
+        ttgrid = self.ttgrid if ttgrid is None else ttgrid
+        if not ttgrid.header == self.header:
+            raise ValueError("travel-time grid does not match query plan")
+        return ttgrid
+
+    def apply(self, station, phase, ttgrid=None):
+        """
+        Return interpolated travel times from a single table.
+
+        :param str station: station
+        :param str phase: phase
+        :param TTGrid ttgrid: grid to read from, if not the grid the
+                              plan was made for; must share its header
+        :returns: travel times with shape (npts,)
+        :rtype: numpy.ndarray
+        """
+        data = self._check(ttgrid)._get_flat(station, phase)[self.index]
+        return np.sum(data * self.weight, axis=1)
+
+    def __call__(self, keys=None, tensor=None, ttgrid=None):
+        """
+        Return interpolated travel times for many tables.
+
+        :param list keys: (station, phase) pairs; defaults to the keys
+                          of the grid. Ignored if **tensor** is given.
+        :param numpy.ndarray tensor: stacked travel-time tensor as
+                                     returned by :meth:`TTGrid.stack`
+        :param TTGrid ttgrid: grid to read from
+        :returns: travel times with shape (npts, nkeys)
+        :rtype: numpy.ndarray
+        """
+        if tensor is not None:
+            flat = tensor.transpose(0, 3, 2, 1).reshape(len(tensor), -1)
+            return np.einsum("kpc,pc->pk", flat[:, self.index], self.weight)
+        ttgrid = self._check(ttgrid)
+        keys = ttgrid.keys if keys is None else keys
+        tt = np.empty((len(self), len(keys)))
+        for ikey, (station, phase) in enumerate(keys):
+            tt[:, ikey] = self.apply(station, phase, ttgrid=ttgrid)
+        return tt
+
+    def gradient(self, keys=None, tensor=None, metric=True, ttgrid=None):
+        """
+        Return travel-time gradients for many tables; see
+        :meth:`TTGrid.get_ttgradient_matrix`.
+
+        :returns: gradients with shape (npts, nkeys, 3)
+        :rtype: numpy.ndarray
+        """
+        if self.dweight is None:
+            raise ValueError("query plan was made without gradient=True")
+        if tensor is not None:
+            flat = tensor.transpose(0, 3, 2, 1).reshape(len(tensor), -1)
+            grad = np.einsum("kpc,pcj->pkj", flat[:, self.index], self.dweight)
+        else:
+            ttgrid = self._check(ttgrid)
+            keys = ttgrid.keys if keys is None else keys
+            grad = np.empty((len(self), len(keys), 3))
+            for ikey, (station, phase) in enumerate(keys):
+                data = ttgrid._get_flat(station, phase)[self.index]
+                grad[:, ikey] = np.einsum("pc,pcj->pj", data, self.dweight)
+        if metric:
+            grad *= self.metric[:, None, :]
+        return grad
+
+
+class DifferentialTTGrid(TTGrid):
+    """
+    Differential travel-time tables *T(a) - T(b)* for pairs of
+    station/phase keys of a base :class:`TTGrid`, so that a pair query
+    costs a single interpolation.
+
+    Tables are stored in **difdir** with the same header and layout as
+    ordinary travel-time files, named *A-B.phase* for pairs of the same
+    phase and *A-B.phaseA-phaseB* otherwise. Missing tables are
+    computed from the base grid and written on first use if **lazy**
+    is True. Every :class:`TTGrid` query method accepts differential
+    keys (see :func:`differential_key`).
+
+    :param TTGrid base: travel-time grid of individual stations
+    :param str difdir: directory of differential tables
+    :param list pairs: pairs of (station, phase) keys to precompute
+    :param bool lazy: materialize missing tables on first access
+    :param int max_open: maximum number of simultaneously open maps
+    :param int max_blocks: maximum number of cached decompressed
+                           blocks of compressed tables
+    """
+    def __init__(self, base, difdir, pairs=(), lazy=True, max_open=256,
+                 max_blocks=4096):
+        self.base = base
+        self.lazy = lazy
+        self.ttdir = os.path.abspath(difdir)
+        os.makedirs(self.ttdir, exist_ok=True)
+        self.max_open = max(1, int(max_open))
+        self.max_blocks = max_blocks
+        self._initialize_cache()
+        self.manifest = None
+        self.paths = _scan(self.ttdir)
+        self.pairs = {}
+        self._initialize_grid(base.header)
+        self._update_keys()
+        for key_a, key_b in pairs:
+            self.materialize(key_a, key_b)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["base"] = self.base
+        state["lazy"] = self.lazy
+        state["pairs"] = self.pairs
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.base = state["base"]
+        self.lazy = state["lazy"]
+        self.pairs = state["pairs"]
+
+    def _update_keys(self):
+        self.keys = sorted((station, phase)
+                           for station in self.paths
+                           for phase in self.paths[station])
+
+    def materialize(self, key_a, key_b, overwrite=False):
+        """
+        Compute and write the differential table *T(key_a) -
+        T(key_b)* unless it already exists.
+
+        :param tuple key_a: (station, phase) of the minuend
+        :param tuple key_b: (station, phase) of the subtrahend
+        :param bool overwrite: recompute an existing table
+        :returns: differential key of the pair
+        :rtype: tuple
+        """
+        station, phase = differential_key(key_a, key_b)
+        with self._lock:
+            self.pairs[(station, phase)] = (tuple(key_a), tuple(key_b))
+            if phase in self.paths.get(station, {}) and not overwrite:
+                return station, phase
+            data = self.base.get_tt_array(*key_a)\
+                - self.base.get_tt_array(*key_b)
+            path = os.path.join(self.ttdir, "{:s}.{:s}".format(station, phase))
+            write_ttgrid(path, self.header, data)
+            if station not in self.paths:
+                self.paths[station] = {}
+            self.paths[station][phase] = path
+            self._update_keys()
+        return station, phase
+
+    def _get_mmap(self, station, phase):
+        with self._lock:
+            if self.lazy and phase not in self.paths.get(station, {})\
+                    and (station, phase) in self.pairs:
+                self.materialize(*self.pairs[(station, phase)])
+            return super()._get_mmap(station, phase)
+
+    def get_dtt_matrix(self, r, theta, phi, pairs):
+        """
+        Return differential travel times *T(a) - T(b)* for every point
+        and pair of (station, phase) keys.
+
+        :param array-like r: radial coordinates
+        :param array-like theta: polar angles
+        :param array-like phi: azimuthal angles
+        :param list pairs: pairs of (station, phase) keys
+        :returns: differential travel times with shape (npts, npairs)
+        :rtype: numpy.ndarray
+        """
+        keys = []
+        with self._lock:
+            for key_a, key_b in pairs:
+                key = differential_key(key_a, key_b)
+                self.pairs[key] = (tuple(key_a), tuple(key_b))
+                keys.append(key)
+        return self.get_tt_matrix(r, theta, phi, keys=keys)
+
+
+def differential_key(key_a, key_b):
+    """
+    Return the (station, phase) key of the differential table of a
+    pair of (station, phase) keys.
+    """
+    (station_a, phase_a), (station_b, phase_b) = key_a, key_b
+    phase = phase_a if phase_a == phase_b\
+        else "{:s}-{:s}".format(phase_a, phase_b)
+    return "{:s}-{:s}".format(station_a, station_b), phase
+
+
+_WORKER_TTGRID = None
+
+
+def _initialize_worker(ttgrid):
+    global _WORKER_TTGRID
+    _WORKER_TTGRID = ttgrid
+
+
+def _call_worker(func, batch):
+    return func(_WORKER_TTGRID, batch)
+
+
+def _get_tt_matrix_batch(ttgrid, batch):
+    r, theta, phi, keys = batch
+    return ttgrid.get_tt_matrix(r, theta, phi, keys=keys)
+
+
+def parallel_map(ttgrid, func, batches, max_workers=None, mp_context=None):
+    """
+    Apply **func** to every batch in a pool of worker processes.
+
+    **ttgrid** is pickled to a lightweight descriptor and sent once to
+    each worker, which reattaches to the travel-time files on first
+    access; **func** is called as *func(ttgrid, batch)* and must be
+    picklable, e.g. a module-level function.
+
+    :param TTGrid ttgrid: travel-time grid
+    :param callable func: function to apply to each batch
+    :param iterable batches: batches of work
+    :param int max_workers: number of worker processes
+    :param mp_context: multiprocessing context for the pool
+    :returns: results in the order of **batches**
+    :rtype: list
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=mp_context,
+            initializer=_initialize_worker,
+            initargs=(ttgrid,)
+    ) as pool:
+        return list(pool.map(functools.partial(_call_worker, func), batches))
+
+
+def parallel_tt_matrix(ttgrid, r, theta, phi, keys=None, batch_size=10000,
+                       max_workers=None, mp_context=None):
+    """
+    Evaluate :meth:`TTGrid.get_tt_matrix` in batches of **batch_size**
+    points fanned out to a pool of worker processes.
+
+    :returns: travel times with shape (npts, nkeys)
+    :rtype: numpy.ndarray
+    """
+    r, theta, phi = np.broadcast_arrays(*[np.atleast_1d(v).ravel()
+                                          for v in (r, theta, phi)])
+    keys = ttgrid.keys if keys is None else keys
+    batches = [(r[i:i+batch_size], theta[i:i+batch_size],
+                phi[i:i+batch_size], keys)
+               for i in range(0, len(r), batch_size)]
+    if not batches:
+        return np.empty((0, len(keys)))
+    return np.concatenate(parallel_map(ttgrid,
+                                       _get_tt_matrix_batch,
+                                       batches,
+                                       max_workers=max_workers,
+                                       mp_context=mp_context))
+
+
+def _scan(ttdir):
+    """
+    Return paths of travel-time files in **ttdir** keyed by station
+    and phase.
+    """
+    paths = {}
+    for infile in sorted(os.listdir(ttdir)):
+        if infile == MANIFEST or infile.startswith("."):
+            continue
+        station, phase = infile.split(".")[:2]
+        if station not in paths:
+            paths[station] = {}
+        paths[station][phase] = os.path.abspath(os.path.join(ttdir, infile))
+    return paths
+
+
+def _scan_entries(ttdir, checksum=True):
+    """
+    Return manifest entries (station, phase, file name, size, header
+    and optionally CRC-32 checksum) for every file in **ttdir**.
+    """
+    paths = _scan(ttdir)
+    entries = []
+    for station in sorted(paths):
+        for phase in sorted(paths[station]):
+            path = paths[station][phase]
+            entry = {"station": station,
+                     "phase": phase,
+                     "file": os.path.basename(path),
+                     "size": os.path.getsize(path)}
+            with open(path, "rb") as infile:
+                entry["header"] = list(_read_header(infile))
+                magic = infile.read(len(_ttcompress.MAGIC))
+                nnodes = entry["header"][0] * entry["header"][1]\
+                    * entry["header"][2]
+                entry["format"] = "ttz" if magic == _ttcompress.MAGIC\
+                    and not entry["size"] == 36 + 4 * nnodes else "raw"
+                if checksum:
+                    infile.seek(0)
+                    crc = 0
+                    for chunk in iter(functools.partial(infile.read, 2 ** 24),
+                                      b""):
+                        crc = zlib.crc32(chunk, crc)
+                    entry["crc32"] = crc
+            entries.append(entry)
+    return entries
+
+
+def write_manifest(ttdir, checksum=True):
+    """
+    Write a manifest of the travel-time files in **ttdir**, holding
+    the shared grid header and the station/phase to file mapping with
+    file sizes and checksums. :class:`TTGrid` trusts the manifest on
+    open instead of scanning the directory.
+
+    :param str ttdir: travel-time directory
+    :param bool checksum: compute CRC-32 checksums of every file
+    :returns: path to the manifest
+    :rtype: str
+    :raises ValueError: if file headers do not match
+    """
+    entries = _scan_entries(ttdir, checksum=checksum)
+    if not entries:
+        raise ValueError("no travel-time files found: {:s}".format(ttdir))
+    header = entries[0]["header"]
+    for entry in entries:
+        if not entry["header"] == header:
+            raise ValueError("travel-time headers do not match: {:s}".format(
+                entry["file"]))
+        del entry["header"]
+    path = os.path.join(ttdir, MANIFEST)
+    # Write atomically so that readers never see a partial manifest.
+    with _atomic.AtomicFile(path, "w") as outfile:
+        json.dump({"version": 1, "header": header, "files": entries},
+                  outfile,
+                  indent=1)
+    return path
+
+
+def grid_header(grid):
+    """
+    Return the travel-time file header (nr, nlat, nlon, dr, dlat,
+    dlon, r0, lat0, lon0) describing a GeoGrid3D, or **grid** itself
+    if it already is a header.
+
+    :param grid: grid specification
+    :type grid: GeoGrid3D or tuple
+    :rtype: tuple
+    """
+    if isinstance(grid, (tuple, list)):
+        return tuple(grid)
+    return (int(grid.nrho), int(grid.nlat), int(grid.nlon),
+            float(grid.drho), float(grid.dlat), float(grid.dlon),
+            float(grid.rho0), float(grid.lat0), float(grid.lon0))
+
+
+class TTGridWriter(object):
+    """
+    Streaming writer of travel-time files in the layout read by
+    :class:`TTGrid`.
+
+    Travel times are written in chunks of whole longitude slices,
+    each with shape (nr, nlat, k), in order of increasing longitude;
+    radius and latitude increase along the first two axes. The file
+    is written to a temporary name and moved into place only when
+    every node has been written, so readers never see partial tables.
+
+    :param str path: output path
+    :param grid: grid specification
+    :type grid: GeoGrid3D or tuple
+    """
+    def __init__(self, path, grid):
+        self.path = os.path.abspath(path)
+        self.header = grid_header(grid)
+        self.nr, self.nlat, self.nlon = self.header[:3]
+        self.nwritten = 0
+        self._outfile = _atomic.AtomicFile(self.path, "wb")
+        self._outfile.file.write(struct.pack("3i3f3f", *self.header))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, chunk):
+        """
+        Write the next chunk of longitude slices.
+
+        :param array-like chunk: travel times with shape (nr, nlat, k)
+        """
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if chunk.ndim == 2:
+            chunk = chunk[..., None]
+        if not chunk.shape[:2] == (self.nr, self.nlat)\
+                or self.nwritten + chunk.shape[2] > self.nlon:
+            raise ValueError("travel-time chunk does not match grid")
+        # Transposing puts r fastest in C order.
+        self._outfile.file.write(chunk.T.tobytes())
+        self.nwritten += chunk.shape[2]
+
+    def close(self):
+        """
+        Finish the file and move it into place.
+        """
+        if self._outfile is None:
+            return
+        if not self.nwritten == self.nlon:
+            self.abort()
+            raise ValueError("travel-time file incomplete: {:d} of {:d} "
+                             "longitude slices written".format(self.nwritten,
+                                                               self.nlon))
+        self._outfile.commit()
+        self._outfile = None
+
+    def abort(self):
+        """
+        Discard the partially written file.
+        """
+        if self._outfile is None:
+            return
+        self._outfile.discard()
+        self._outfile = None
+
+
+def write_ttgrid(path, grid, data):
+    """
+    Write a travel-time file readable by :class:`TTGrid`.
+
+    :param str path: output path
+    :param grid: grid specification
+    :type grid: GeoGrid3D or tuple
+    :param data: travel times with shape (nr, nlat, nlon), or an
+                 iterable of chunks with shape (nr, nlat, k) (see
+                 :class:`TTGridWriter`)
+    :returns: output path
+    :rtype: str
+    """
+    with TTGridWriter(path, grid) as writer:
+        if isinstance(data, np.ndarray):
+            writer.write(data)
+        else:
+            for chunk in data:
+                writer.write(chunk)
+    return writer.path
+
+
+def _write_station_table(args):
+    ttdir, grid, func, station, phase, ext = args
+    path = os.path.join(ttdir, "{:s}.{:s}{:s}".format(station, phase, ext))
+    return write_ttgrid(path, grid, func(station, phase, grid))
+
+
+def write_tables(ttdir, grid, func, keys, ext="", max_workers=None,
+                 manifest=True, mp_context=None, checkpoint=None,
+                 initializer=None, initargs=()):
+    """
+    Build the travel-time table of every (station, phase) key in a
+    pool of worker processes.
+
+    **func** is called as *func(station, phase, grid)* in the workers
+    and returns travel times as accepted by :func:`write_ttgrid`; it
+    must be picklable, e.g. a module-level function or a
+    functools.partial of one. **func** is pickled with every job, so
+    large inputs shared by all jobs should instead be sent once to
+    each worker with **initializer** and **initargs**.
+
+    With **checkpoint**, each key is appended to that file as soon as
+    its table is written, and keys already listed there are skipped
+    if their tables are complete (header matching **grid** and full
+    size), so an interrupted run can be resumed by calling this
+    function again with the same arguments. Incomplete tables are
+    rebuilt.
+
+    :param str ttdir: output directory
+    :param grid: grid specification
+    :type grid: GeoGrid3D or tuple
+    :param callable func: travel-time generator
+    :param list keys: (station, phase) pairs
+    :param str ext: file name extension, e.g. ".tt"
+    :param int max_workers: number of worker processes
+    :param bool manifest: write a manifest when done
+    :param mp_context: multiprocessing context for the pool
+    :param str checkpoint: path of a checkpoint file
+    :param callable initializer: called as *initializer(\*initargs)*
+                                 at the start of each worker process
+    :param tuple initargs: arguments of **initializer**
+    :returns: paths of the written files
+    :rtype: list
+    """
+    os.makedirs(ttdir, exist_ok=True)
+    paths = {(station, phase): os.path.join(ttdir,
+                                            "{:s}.{:s}{:s}".format(station,
+                                                                   phase,
+                                                                   ext))
+             for station, phase in keys}
+    done = set()
+    if checkpoint is not None:
+        header = grid_header(grid)
+        done = {key for key in read_checkpoint(checkpoint)
+                if key in paths and _is_complete(paths[key], header)}
+    jobs = [(ttdir, grid, func, station, phase, ext)
+            for station, phase in keys if (station, phase) not in done]
+    outfile = None
+    if checkpoint is not None:
+        outfile = open(checkpoint, "a+")
+        # Terminate a line left partial by an interrupted run.
+        if outfile.tell() > 0:
+            outfile.seek(outfile.tell() - 1)
+            if not outfile.read(1) == "\n":
+                outfile.write("\n")
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=mp_context,
+                initializer=initializer,
+                initargs=initargs
+        ) as pool:
+            futures = {pool.submit(_write_station_table, job): job[3:5]
+                       for job in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                if outfile is not None:
+                    outfile.write(json.dumps(list(futures[future])) + "\n")
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+    finally:
+        if outfile is not None:
+            outfile.close()
+    if manifest:
+        write_manifest(ttdir)
+    return [paths[(station, phase)] for station, phase in keys]
+
+
+def read_checkpoint(path):
+    """
+    Return the (station, phase) keys recorded in a checkpoint file
+    written by :func:`write_tables`. Lines that are not keys, such as
+    a truncated last line, are ignored.
+
+    :param str path: checkpoint path
+    :rtype: set
+    """
+    keys = set()
+    if not os.path.isfile(path):
+        return keys
+    with open(path) as infile:
+        for line in infile:
+            try:
+                key = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(key, list) and len(key) == 2:
+                keys.add(tuple(key))
+    return keys
+
+
+def _read_header(infile):
+    """
+    Return the 36-byte grid definition at the start of a travel-time
+    file as (nr, nlat, nlon, dr, dlat, dlon, r0, lat0, lon0).
+    """
+    return struct.unpack("3i3f3f", infile.read(36))
+
+
+def _is_complete(path, header):
+    """
+    Return True if **path** is a raw travel-time file with grid
+    definition **header** and a travel time for every node.
+    """
+    # Round the header through the file format before comparing.
+    header = struct.unpack("3i3f3f", struct.pack("3i3f3f", *header))
+    try:
+        with open(path, "rb") as infile:
+            if not _read_header(infile) == header:
+                return False
+    except (OSError, struct.error):
+        return False
+    return os.path.getsize(path) == 36 + 4 * header[0] * header[1] * header[2]
+
+
+def _close_mmap(mmf):
+    if isinstance(mmf, _ttcompress.CompressedTable):
+        # Other threads may still be reading the table; dropping the
+        # cache's reference is enough, and the map is released when
+        # the last reader lets go of it.
+        return
+    try:
+        mmf.close()
+    except BufferError:
+        # Arrays still reference the map; it is released when they are
+        # garbage collected.
+        pass
+
 
 def test():
     ttg = TTGrid("/home/shake/malcolcw/data/fm3d_ttimes")
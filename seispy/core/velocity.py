@@ -265,6 +265,65 @@ class VelocityModel(object):
 
         return (V)
 
+    def get_velocity(self, phase, rho, theta, phi, gradient=False):
+        """
+        Return **phase**-velocity at many spherical coordinates at
+        once by trilinear interpolation. Coordinates outside the model
+        are clamped to its edges, as in :meth:`_get_V`.
+
+        :param str phase: phase
+        :param array-like rho: radial coordinates
+        :param array-like theta: polar coordinates
+        :param array-like phi: azimuthal coordinates
+        :param bool gradient: also return partial derivatives of
+                              velocity with respect to (rho, theta,
+                              phi), which are zero outside the model
+        :returns: **phase**-velocity with the broadcast shape of the
+                  coordinates, and its partial derivatives with an
+                  extra trailing axis of length 3 if **gradient** is
+                  True
+        :rtype: numpy.ndarray or (numpy.ndarray, numpy.ndarray)
+        """
+        phase = _verify_phase(phase)
+        VV = self._Vp if phase == "P" else self._Vs
+        nodes = np.asarray(self._nodes)
+        axes = (nodes[:, 0, 0, 0], nodes[0, :, 0, 1], nodes[0, 0, :, 2])
+        index, weight, dweight = [], [], []
+        coords = np.broadcast_arrays(rho, theta, phi)
+        for axis, coord in zip(axes, coords):
+            coord = np.asarray(coord, dtype=np.float64)
+            x = np.clip(coord, axis[0], axis[-1])
+            if len(axis) == 1:
+                i0 = np.zeros(x.shape, dtype=np.intp)
+                index.append((i0, i0))
+                weight.append(np.zeros(x.shape))
+                dweight.append(np.zeros(x.shape))
+                continue
+            i0 = np.clip(np.searchsorted(axis, x, side="right") - 1,
+                         0,
+                         len(axis) - 2)
+            h = axis[i0 + 1] - axis[i0]
+            index.append((i0, i0 + 1))
+            weight.append((x - axis[i0]) / h)
+            dweight.append(np.where(coord == x, 1 / h, 0.))
+        V = 0
+        dV = [0, 0, 0]
+        for corner in np.ndindex(2, 2, 2):
+            VVc = VV[index[0][corner[0]],
+                     index[1][corner[1]],
+                     index[2][corner[2]]]
+            w = [weight[iaxis] if k else 1 - weight[iaxis]
+                 for iaxis, k in enumerate(corner)]
+            V = V + w[0] * w[1] * w[2] * VVc
+            if gradient:
+                for iaxis, k in enumerate(corner):
+                    dw = dweight[iaxis] if k else -dweight[iaxis]
+                    others = [w[j] for j in range(3) if j != iaxis]
+                    dV[iaxis] = dV[iaxis] + dw * others[0] * others[1] * VVc
+        if gradient:
+            return(V, np.stack(np.broadcast_arrays(*dV), axis=-1))
+        return(V)
+
     def regrid(self, R, T, P):
         Vp = np.empty(shape=R.shape)
         Vs = np.empty(shape=R.shape)
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from seispy.core import atomic
+
+
+def test_commit_syncs_before_rename(tmp_path, monkeypatch):
+    path = str(tmp_path / "table")
+    calls = []
+    fsync, replace = os.fsync, os.replace
+    monkeypatch.setattr(os, "fsync",
+                        lambda fd: calls.append("fsync") or fsync(fd))
+    monkeypatch.setattr(os, "replace",
+                        lambda *args: calls.append("replace")
+                        or replace(*args))
+    with atomic.AtomicFile(path, "w") as outfile:
+        outfile.write("data")
+    # The file is synced before it is renamed, and the directory after.
+    assert calls == ["fsync", "replace", "fsync"]
+    with open(path) as infile:
+        assert infile.read() == "data"
+    assert os.listdir(str(tmp_path)) == ["table"]
+
+
+def test_discard_on_error(tmp_path):
+    path = str(tmp_path / "table")
+    with open(path, "w") as outfile:
+        outfile.write("old")
+    with pytest.raises(RuntimeError):
+        with atomic.AtomicFile(path, "w") as outfile:
+            outfile.write("new")
+            raise RuntimeError
+    with open(path) as infile:
+        assert infile.read() == "old"
+    assert os.listdir(str(tmp_path)) == ["table"]
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from seispy.core import eikonal
+
+
+@pytest.fixture(scope="module")
+def errors():
+    return eikonal.accuracy()
+
+
+# Maximum and RMS absolute errors (s) against the analytic travel
+# times, which reach about 8 s across the test grid.
+@pytest.mark.parametrize("model, max_error, rms_error",
+                         [("homogeneous", 0.05, 0.02),
+                          ("gradient", 0.04, 0.015)])
+def test_accuracy(errors, model, max_error, rms_error):
+    emax, erms = errors[model]
+    assert emax < max_error
+    assert erms < rms_error
+
+
+def test_source_outside_grid():
+    grid = eikonal._test_grid((5, 6, 6))
+    with pytest.raises(ValueError):
+        eikonal.solve(np.full((5, 6, 6), 6.), grid, (grid.lat0 - 1.,
+                                                     grid.lon0,
+                                                     10.))
@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pytest
+
+from seispy.core import fmm3dio
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+
+def _path_index(index):
+    return [tuple(int(row[field]) for field in ("receiver", "source", "path"))
+            for row in index]
+
+
+@pytest.mark.parametrize("chunk_size", [2, 1000])
+def test_read_rays_sample(chunk_size):
+    rays, index = fmm3dio.read_rays(os.path.join(DATA, "rays.dat"),
+                                    chunk_size=chunk_size)
+    assert _path_index(index) == [(1, 1, 1), (2, 1, 1), (3, 2, 1)]
+    np.testing.assert_array_equal(index["tele"], [False, True, False])
+    np.testing.assert_array_equal(rays.length, [3, 4, 1])
+    # Both sections of the second ray are concatenated.
+    np.testing.assert_allclose(rays[1], [[6371., 0.58, -2.04],
+                                         [6368., 0.5802, -2.0403],
+                                         [6365., 0.5804, -2.0406],
+                                         [6360., 0.5806, -2.0409]])
+    np.testing.assert_allclose(rays[2], [[6359., 0.581, -2.041]])
+
+
+@pytest.mark.parametrize("chunk_size", [2, 1000])
+def test_read_frechet_sample(chunk_size):
+    frechet, index = fmm3dio.read_frechet(os.path.join(DATA, "frechet.dat"),
+                                          chunk_size=chunk_size)
+    assert _path_index(index) == [(1, 1, 1), (2, 1, 1), (3, 2, 1)]
+    assert frechet.format == "csr"
+    assert frechet.shape == (3, 8)
+    expected = np.zeros((3, 8))
+    expected[0, [2, 6]] = 0.125, -0.025
+    expected[2, [0, 2, 7]] = 1., 0.5, 0.075
+    np.testing.assert_allclose(frechet.toarray(), expected)
+    np.testing.assert_array_equal(frechet.indptr, [0, 2, 2, 5])
+    assert fmm3dio.read_frechet(os.path.join(DATA, "frechet.dat"),
+                                nparams=10)[0].shape == (3, 10)
+
+
+def test_rays_round_trip(tmp_path):
+    rng = np.random.default_rng(5)
+    path = str(tmp_path / "rays.dat")
+    expected, headers = [], []
+    with open(path, "w") as outfile:
+        for iray in range(50):
+            sections = [rng.uniform(0., 1., (rng.integers(1, 6), 3))
+                        for _ in range(rng.integers(1, 4))]
+            tele = bool(rng.integers(2))
+            headers.append((iray + 1, iray % 7 + 1, iray % 3 + 1, tele))
+            outfile.write("{:6d}{:6d}{:6d}{:6d} {:s}\n".format(
+                *headers[-1][:3], len(sections), "T" if tele else "F"))
+            for isec, section in enumerate(sections):
+                outfile.write("{:6d}{:6d} {:s} F\n".format(
+                    len(section), isec + 1, "TF"[isec % 2]))
+                np.savetxt(outfile, section, fmt="%15.10f")
+            expected.append(np.concatenate(sections))
+    rays, index = fmm3dio.read_rays(path, chunk_size=17)
+    assert [row[:3] for row in headers] == _path_index(index)
+    np.testing.assert_array_equal(index["tele"],
+                                  [row[3] for row in headers])
+    assert len(rays) == len(expected)
+    for iray, points in enumerate(expected):
+        np.testing.assert_allclose(rays[iray], points, rtol=1e-6, atol=1e-7)
+
+
+def test_frechet_round_trip(tmp_path):
+    expected = np.zeros((40, 25))
+    rng = np.random.default_rng(6)
+    mask = rng.uniform(size=expected.shape) < 0.2
+    expected[mask] = rng.normal(size=mask.sum())
+    path = str(tmp_path / "frechet.dat")
+    with open(path, "w") as outfile:
+        for irow, row in enumerate(expected):
+            nonzero = np.flatnonzero(row)
+            outfile.write("{:6d}{:6d}{:6d}{:6d}\n".format(irow + 1, 1, 1,
+                                                         len(nonzero)))
+            for iparam in nonzero:
+                outfile.write("{:6d} {:.17e}\n".format(iparam + 1,
+                                                      row[iparam]))
+    frechet, index = fmm3dio.read_frechet(path, nparams=25, chunk_size=13)
+    assert isinstance(frechet, fmm3dio.scipy.sparse.csr_matrix)
+    np.testing.assert_array_equal(index["receiver"], np.arange(1, 41))
+    np.testing.assert_allclose(frechet.toarray(), expected, rtol=1e-15)
+    assert frechet.nnz == mask.sum()
+
+
+def test_read_arrivals_flags(tmp_path):
+    path = str(tmp_path / "arrivals.dat")
+    with open(path, "w") as outfile:
+        outfile.write("1 1 1 2.5 T\n2 1 1 -1.0 F\n")
+    arrivals = fmm3dio.read_arrivals(path)
+    np.testing.assert_array_equal(arrivals["valid"], [True, False])
+    np.testing.assert_array_equal(arrivals["time"], [2.5, -1.])
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from seispy.core import constants, geogrid, locate, ttgrid
+
+
+@pytest.fixture(scope="module")
+def ttg(tmp_path_factory):
+    """
+    Straight-ray P and S tables for stations scattered over the top
+    of a small grid.
+    """
+    ttdir = tmp_path_factory.mktemp("tt")
+    grid = geogrid.GeoGrid3D(33., -117., 0., 21, 21, 11, 0.02, 0.025, 2.)
+    header = ttgrid.grid_header(grid)
+    nr, nlat, nlon, dr, dlat, dlon, r0, lat0, lon0 = header
+    R, LAT, LON = np.meshgrid(r0 + dr * np.arange(nr),
+                              lat0 + dlat * np.arange(nlat),
+                              lon0 + dlon * np.arange(nlon),
+                              indexing="ij")
+    rng = np.random.default_rng(1)
+    for ista in range(8):
+        lat = lat0 + rng.uniform(0, (nlat - 1) * dlat)
+        lon = lon0 + rng.uniform(0, (nlon - 1) * dlon)
+        dist = np.linalg.norm(_cartesian(R, LAT, LON)
+                              - _cartesian(constants.EARTH_RADIUS, lat, lon),
+                              axis=-1)
+        for phase, v in (("P", 6.), ("S", 3.5)):
+            ttgrid.write_ttgrid(str(ttdir / "S{:02d}.{:s}".format(ista,
+                                                                  phase)),
+                                grid,
+                                dist / v)
+    with ttgrid.TTGrid(str(ttdir)) as ttg:
+        yield ttg
+
+
+def _cartesian(r, lat, lon):
+    theta, phi = np.radians(90. - lat), np.radians(lon)
+    return np.stack([r * np.sin(theta) * np.cos(phi),
+                     r * np.sin(theta) * np.sin(phi),
+                     r * np.cos(theta)], axis=-1)
+
+
+@pytest.mark.parametrize("norm", locate.NORMS)
+@pytest.mark.parametrize("stride", [1, 4, 8])
+def test_locate_noise_free(ttg, norm, stride):
+    locator = locate.GridSearchLocator(ttg, norm=norm, stride=stride)
+    rng = np.random.default_rng(0)
+    ikeys = np.arange(len(ttg.keys))
+    for _ in range(20):
+        ir, itheta, iphi = (rng.integers(n)
+                            for n in (ttg.nr, ttg.ntheta, ttg.nphi))
+        times = 100. + np.array([ttg.get_node_tt(station, phase,
+                                                 ir, itheta, iphi)
+                                 for station, phase in ttg.keys])
+        solution = locator.locate_event(ikeys, times)
+        assert solution["lat"] == pytest.approx(ttg.lat0 + itheta * ttg.dlat)
+        assert solution["lon"] == pytest.approx(ttg.lon0 + iphi * ttg.dlon)
+        assert solution["depth"] == pytest.approx(
+            constants.EARTH_RADIUS - ttg.r0 - ir * ttg.dr)
+        assert solution["time"] == pytest.approx(100., abs=1e-4)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("fmm3d")
+
+from seispy.core import propagate
+
+
+@pytest.fixture
+def fake_run(monkeypatch):
+    """
+    Replace fm3d.run by a straight-ray stand-in that records the size
+    of every ray buffer it is given.
+    """
+    nbytes = []
+
+    def run(sources, nsources, receivers, nreceivers, rays, tts):
+        assert rays.shape[:2] == tts.shape[:2] == (nsources, nreceivers)
+        assert rays.flags.f_contiguous and tts.flags.f_contiguous
+        nbytes.append(rays.nbytes)
+        for isrc in range(nsources):
+            for irx in range(nreceivers):
+                dist = np.linalg.norm(receivers[irx] - sources[isrc])
+                tts[isrc, irx] = dist / 6., dist / 3.5
+                npts = min(_npts(receivers[irx]), rays.shape[3])
+                rays[isrc, irx, :, :npts] = np.linspace(sources[isrc],
+                                                        receivers[irx],
+                                                        npts)
+
+    monkeypatch.setattr(propagate.fm3d, "run", run)
+    return nbytes
+
+
+def _npts(receiver):
+    # Ray lengths vary with the receiver, wherever it falls in a block.
+    return 2 + int(receiver[0] * 1000.) % 3
+
+
+def _coords(n, depth, seed):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(33., 34., n),
+                            rng.uniform(-117., -116., n),
+                            np.full(n, depth)])
+
+
+def _expected_tts(sources, receivers):
+    dist = np.linalg.norm(receivers[np.newaxis] - sources[:, np.newaxis],
+                          axis=-1)
+    return np.stack([dist / 6., dist / 3.5], axis=-1).astype(np.float32)
+
+
+def test_reciprocal_without_rays_many_receivers(fake_run):
+    # Propagating from the stations samples fm3d at every event; the
+    # ray buffer must not grow with the number of events.
+    stations = _coords(3, 0., 0)
+    events = _coords(20000, 10., 1)
+    prop = object.__new__(propagate.Propagator)
+    rays, tts = prop(events, stations, reciprocal=True, rays=False)
+    assert rays is None
+    assert tts.shape == (len(events), len(stations), 2)
+    np.testing.assert_allclose(tts, _expected_tts(events, stations),
+                               rtol=1e-6)
+    assert len(fake_run) == len(stations)
+    assert max(fake_run) <= 2 * len(events) * 3 * 4
+
+
+def test_ray_buffer_is_bounded(fake_run, monkeypatch):
+    monkeypatch.setattr(propagate, "RAY_BUFFER_SIZE",
+                        4 * 2 * propagate.MAXPTS * 3 * 4)
+    sources, receivers = _coords(2, 10., 2), _coords(10, 0., 3)
+    rays, tts = propagate._run(sources, receivers)
+    assert max(fake_run) <= propagate.RAY_BUFFER_SIZE
+    # Three blocks of receivers per source.
+    assert len(fake_run) == 2 * 3
+    np.testing.assert_allclose(tts, _expected_tts(sources, receivers),
+                               rtol=1e-6)
+    assert rays.shape == (2, 10, 2)
+    for isrc in range(2):
+        for irx in range(10):
+            ray = rays[isrc, irx, 1]
+            assert len(ray) == _npts(receivers[irx])
+            np.testing.assert_allclose(ray[[0, -1]],
+                                       [sources[isrc], receivers[irx]],
+                                       rtol=1e-6)
@@ -0,0 +1,84 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from seispy.core import geogrid, ttbuild, ttgrid
+
+
+class Homogeneous(object):
+    """
+    Constant-velocity stand-in for a VelocityModel.
+    """
+    def __init__(self, vp=6., vs=3.5):
+        self.velocity = {"P": vp, "S": vs}
+
+    def get_velocity(self, phase, r, theta, phi):
+        return np.full(np.shape(r), self.velocity[phase])
+
+
+@pytest.fixture
+def grid():
+    return geogrid.GeoGrid3D(33., -117., 0., 6, 7, 5, 0.02, 0.025, 2.)
+
+
+@pytest.fixture
+def site():
+    return pd.DataFrame({"sta": ["AAA", "BBB"],
+                         "lat": [33.03, 33.09],
+                         "lon": [-116.97, -116.88],
+                         "elev": [0.5, 1.2]})
+
+
+def _build(ttdir, grid, site, **kwargs):
+    return ttbuild.build_tables(str(ttdir), Homogeneous(), site, grid,
+                                max_workers=1, **kwargs)
+
+
+def test_resume_rebuilds_truncated_tables(tmp_path, grid, site):
+    paths = _build(tmp_path, grid, site)
+    with ttgrid.TTGrid(str(tmp_path)) as ttg:
+        expected = {key: np.array(ttg.get_tt_array(*key)) for key in ttg.keys}
+    # A table recorded in the checkpoint but cut short, as by a crash.
+    size = os.path.getsize(paths[0])
+    with open(paths[0], "r+b") as outfile:
+        outfile.truncate(size - 4)
+    _build(tmp_path, grid, site)
+    assert os.path.getsize(paths[0]) == size
+    with ttgrid.TTGrid(str(tmp_path), verify=True) as ttg:
+        for key in ttg.keys:
+            np.testing.assert_array_equal(ttg.get_tt_array(*key),
+                                          expected[key])
+
+
+def test_resume_rejects_moved_stations(tmp_path, grid, site):
+    _build(tmp_path, grid, site)
+    moved = site.copy()
+    moved.loc[0, "lat"] += 0.01
+    with pytest.raises(ValueError, match="different model"):
+        _build(tmp_path, grid, moved)
+    _build(tmp_path, grid, moved, resume=False)
+
+
+def test_station_outside_grid(tmp_path, grid, site):
+    outside = pd.concat([site,
+                         pd.DataFrame({"sta": ["FAR"],
+                                       "lat": [34.],
+                                       "lon": [-116.9],
+                                       "elev": [0.]})])
+    with pytest.raises(ValueError, match="FAR"):
+        _build(tmp_path, grid, outside)
+    # The build fails before any table is written.
+    assert not [name for name in os.listdir(str(tmp_path))
+                if not name.startswith(".")]
+
+
+def test_checkpoint_records_tables(tmp_path, grid, site):
+    _build(tmp_path, grid, site)
+    with open(os.path.join(str(tmp_path), ttbuild.CHECKPOINT)) as infile:
+        assert "fingerprint" in json.loads(infile.readline())
+    assert ttgrid.read_checkpoint(
+        os.path.join(str(tmp_path), ttbuild.CHECKPOINT)
+    ) == {(sta, phase) for sta in site["sta"] for phase in ("P", "S")}
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from seispy.core import geogrid, ttcompress, ttgrid
+
+BLOCK_SHAPE = (4, 4, 4)
+STEP = 1e-3
+
+
+@pytest.fixture(scope="module")
+def rawdir(tmp_path_factory):
+    """
+    Raw tables on a grid that is not a whole number of blocks: one
+    smooth table, and one so steep that some blocks span more than
+    65535 int16 steps.
+    """
+    rawdir = tmp_path_factory.mktemp("raw")
+    grid = geogrid.GeoGrid3D(33., -117., 0., 11, 13, 10, 0.02, 0.025, 2.)
+    shape = ttgrid.grid_header(grid)[:3]
+    IR, ITHETA, IPHI = np.meshgrid(*map(np.arange, shape), indexing="ij")
+    rng = np.random.default_rng(3)
+    smooth = np.sqrt((IR + 3.) ** 2 + ITHETA ** 2 + IPHI ** 2)\
+        + rng.uniform(0., 0.01, shape)
+    steep = np.where(IPHI < 8, 1., 40.) * (IR + ITHETA + IPHI)\
+        + rng.uniform(0., 1., shape)
+    for station, data in (("SMOOTH", smooth), ("STEEP", steep)):
+        ttgrid.write_ttgrid(str(rawdir / "{:s}.P".format(station)),
+                            grid,
+                            data)
+    return str(rawdir)
+
+
+def _compressed_dir(rawdir, tmp_path, codec):
+    outdir = str(tmp_path / codec)
+    ttcompress.compress_directory(rawdir, outdir, codec=codec, step=STEP,
+                                  block_shape=BLOCK_SHAPE)
+    return outdir
+
+
+def _bound(codec, data):
+    """
+    Documented per-node error bound of **codec** on the table
+    **data**, plus the float32 rounding of the decoded value.
+    """
+    rounding = np.spacing(np.float32(np.abs(data).max()))
+    if codec == "lossless":
+        return np.zeros(data.shape)
+    bound = np.empty(data.shape)
+    for index in np.ndindex(*[-(-n // b)
+                              for n, b in zip(data.shape, BLOCK_SHAPE)]):
+        block = tuple(slice(i * b, (i + 1) * b)
+                      for i, b in zip(index, BLOCK_SHAPE))
+        brange = np.float64(data[block].max()) - data[block].min()
+        if codec == "int16":
+            bound[block] = 0. if brange / STEP > 65535 else STEP / 2
+        else:
+            bound[block] = 2. ** -11 * brange
+    return bound + rounding
+
+
+@pytest.mark.parametrize("codec", ttcompress.CODECS)
+def test_codec_error_bound(rawdir, tmp_path, codec):
+    outdir = _compressed_dir(rawdir, tmp_path, codec)
+    with ttgrid.TTGrid(rawdir) as raw, ttgrid.TTGrid(outdir) as packed:
+        for station, phase in raw.keys:
+            expected = raw.get_tt_array(station, phase)
+            actual = packed.get_tt_array(station, phase)
+            bound = _bound(codec, expected)
+            error = np.abs(actual.astype(np.float64) - expected)
+            if codec == "lossless":
+                np.testing.assert_array_equal(actual, expected)
+            assert np.all(error <= bound), np.max(error - bound)
+        # Trilinear interpolation is a convex combination of nodes, so
+        # interpolated times keep the largest node bound of the table.
+        rng = np.random.default_rng(4)
+        r = raw.r0 + rng.uniform(0, raw.nr - 1, 500) * raw.dr
+        theta = raw.theta0 - rng.uniform(0, raw.ntheta - 1, 500) * raw.dtheta
+        phi = raw.phi0 + rng.uniform(0, raw.nphi - 1, 500) * raw.dphi
+        error = np.abs(packed.get_tt_matrix(r, theta, phi).astype(np.float64)
+                       - raw.get_tt_matrix(r, theta, phi))
+        bound = [_bound(codec, raw.get_tt_array(*key)).max()
+                 for key in raw.keys]
+        assert np.all(error <= np.array(bound))
+
+
+def test_int16_wide_blocks_are_lossless(rawdir, tmp_path):
+    outdir = _compressed_dir(rawdir, tmp_path, "int16")
+    with ttgrid.TTGrid(rawdir) as raw, ttgrid.TTGrid(outdir) as packed:
+        expected = raw.get_tt_array("STEEP", "P")
+        # Nodes of blocks stored losslessly have no quantisation bound.
+        wide = _bound("int16", expected) < STEP / 2
+        assert np.any(wide) and not np.all(wide)
+        np.testing.assert_array_equal(packed.get_tt_array("STEEP", "P")[wide],
+                                      expected[wide])
+
+
+def test_int16_rejects_nonpositive_step(rawdir, tmp_path):
+    with pytest.raises(ValueError):
+        ttcompress.compress_directory(rawdir, str(tmp_path), codec="int16",
+                                      step=0.)
+
+
+def test_block_cache_eviction():
+    cache = ttcompress.BlockCache(max_blocks=2)
+    loads = []
+
+    def loader(key):
+        return lambda: loads.append(key) or key
+
+    assert cache.get("a", loader("a")) == "a"
+    assert cache.get("b", loader("b")) == "b"
+    # A hit makes "a" the most recently used block, so "b" is evicted.
+    assert cache.get("a", loader("a")) == "a"
+    assert cache.get("c", loader("c")) == "c"
+    assert list(cache._blocks) == ["a", "c"]
+    assert cache.get("b", loader("b")) == "b"
+    assert loads == ["a", "b", "c", "b"]
+    cache.clear()
+    assert not cache._blocks
+
+
+def test_small_block_cache(rawdir, tmp_path):
+    outdir = _compressed_dir(rawdir, tmp_path, "lossless")
+    with ttgrid.TTGrid(rawdir) as raw,\
+            ttgrid.TTGrid(outdir, max_blocks=1) as packed:
+        for station, phase in raw.keys:
+            np.testing.assert_array_equal(packed.get_tt_array(station, phase),
+                                          raw.get_tt_array(station, phase))
+        assert len(packed._blocks._blocks) == 1
@@ -0,0 +1,90 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+from seispy.core import geogrid, ttcompress, ttgrid
+
+
+@pytest.fixture(scope="module")
+def ttdir(tmp_path_factory):
+    """
+    Random P and S tables for six stations on a small grid.
+    """
+    ttdir = tmp_path_factory.mktemp("tt")
+    grid = geogrid.GeoGrid3D(33., -117., 0., 9, 11, 13, 0.02, 0.025, 2.)
+    shape = ttgrid.grid_header(grid)[:3]
+    rng = np.random.default_rng(2)
+    for ista in range(6):
+        for phase in ("P", "S"):
+            ttgrid.write_ttgrid(str(ttdir / "S{:02d}.{:s}".format(ista,
+                                                                  phase)),
+                                grid,
+                                rng.uniform(0., 30., shape))
+    return str(ttdir)
+
+
+def _points(ttg, npts, seed=0):
+    rng = np.random.default_rng(seed)
+    r = ttg.r0 + rng.uniform(0, ttg.nr - 1, npts) * ttg.dr
+    theta = ttg.theta0 - rng.uniform(0, ttg.ntheta - 1, npts) * ttg.dtheta
+    phi = ttg.phi0 + rng.uniform(0, ttg.nphi - 1, npts) * ttg.dphi
+    return r, theta, phi
+
+
+def check_concurrent(ttg, nthreads=16, npts=50, niter=5):
+    """
+    Query **ttg** from many threads at once and assert that every
+    thread gets the travel times of a serial evaluation.
+    """
+    r, theta, phi = _points(ttg, npts)
+    expected_matrix = ttg.get_tt_matrix(r, theta, phi)
+    expected_tt = np.array([[ttg.get_tt(station, phase, *point)
+                             for station, phase in ttg.keys]
+                            for point in zip(r, theta, phi)])
+    ttg.close()
+
+    def work(ithread):
+        for _ in range(niter):
+            if ithread % 2:
+                np.testing.assert_array_equal(
+                    ttg.get_tt_matrix(r, theta, phi), expected_matrix)
+            else:
+                np.testing.assert_array_equal(
+                    [[ttg.get_tt(station, phase, *point)
+                      for station, phase in ttg.keys]
+                     for point in zip(r, theta, phi)],
+                    expected_tt)
+
+    # Assertion errors raised in the workers propagate through
+    # future.result().
+    with concurrent.futures.ThreadPoolExecutor(nthreads) as pool:
+        for future in [pool.submit(work, ithread)
+                       for ithread in range(nthreads)]:
+            future.result()
+
+
+def test_serial_matrix_matches_get_tt(ttdir):
+    with ttgrid.TTGrid(ttdir) as ttg:
+        r, theta, phi = _points(ttg, 50)
+        matrix = ttg.get_tt_matrix(r, theta, phi)
+        expected = [[ttg.get_tt(station, phase, *point)
+                     for station, phase in ttg.keys]
+                    for point in zip(r, theta, phi)]
+        np.testing.assert_allclose(matrix, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize("max_open", [1, 2, 256])
+def test_concurrent_queries(ttdir, max_open):
+    # A small max_open forces maps to be evicted and reopened while
+    # other threads read them.
+    with ttgrid.TTGrid(ttdir, max_open=max_open) as ttg:
+        check_concurrent(ttg)
+
+
+def test_concurrent_compressed_queries(ttdir, tmp_path):
+    # Tables and decompressed blocks are both evicted while in use.
+    ttcompress.compress_directory(ttdir, str(tmp_path), codec="lossless",
+                                  block_shape=(4, 4, 4))
+    with ttgrid.TTGrid(str(tmp_path), max_open=2, max_blocks=2) as ttg:
+        check_concurrent(ttg, nthreads=8, niter=2)